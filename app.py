@@ -1,25 +1,79 @@
-from flask import Flask, render_template, send_from_directory, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, get_template_attribute, send_from_directory, request, redirect, url_for, flash, jsonify, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.schema import CreateIndex
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from werkzeug.local import LocalProxy
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, date, timedelta
+import click
+import hashlib
 import logging
+import threading
 import uuid
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 import json
+import time
 import os
+import sqlite3
+import struct
+import zlib
+from functools import lru_cache
+from types import SimpleNamespace
 
 # Configure Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'dev-secret-key-change-this'
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-this')
 
 # Check for Docker environment variable, else use local path
 db_path = os.environ.get('SQLALCHEMY_DATABASE_URI', 'sqlite:///habitflow_v3.db')
 app.config['SQLALCHEMY_DATABASE_URI'] = db_path
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+def build_engine_options(uri):
+    # Pool sizing is tunable per deployment (DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE)
+    if uri.startswith('sqlite'):
+        if ':memory:' in uri or uri in ('sqlite://', 'sqlite:///'):
+            return {}
+        return {
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+            'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+            'connect_args': {
+                'timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)) / 1000,
+                'check_same_thread': False,
+            },
+        }
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = build_engine_options(db_path)
+
+@event.listens_for(Engine, 'connect')
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    # WAL lets the state pollers read while a toggle is writing; the rest trades durability
+    # of the last transaction on power loss (not on crash) for far fewer fsyncs
+    if not isinstance(dbapi_connection, sqlite3.Connection): return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=" + os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'))
+    cursor.execute(f"PRAGMA busy_timeout={int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))}")
+    cursor.execute(f"PRAGMA cache_size={int(os.environ.get('SQLITE_CACHE_SIZE', -65536))}")
+    cursor.execute(f"PRAGMA mmap_size={int(os.environ.get('SQLITE_MMAP_SIZE', 268435456))}")
+    cursor.close()
+
 db = SQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -34,8 +88,46 @@ class User(UserMixin, db.Model):
     current_streak = db.Column(db.Integer, default=0)
     last_completed_date = db.Column(db.Date, nullable=True)
     screen_time_limit = db.Column(db.Integer, default=120) # Minutes
+    state_version = db.Column(db.Integer, default=0) # Bumped on every dashboard-relevant change (ETag)
+    limits_version = db.Column(db.Integer, default=0) # Bumped when AppLimit rows change (get_config ETag)
+    friends_version = db.Column(db.Integer, default=0) # Bumped when a Friendship row of the user changes
+    usage_cursor = db.Column(db.Integer, default=0) # Focus client sync cursor, advanced per accepted upload
+
+    # Running counters for achievements, kept in sync by the mutating routes
+    habits_created_count = db.Column(db.Integer, default=0) # Habits currently owned
+    habit_completions_count = db.Column(db.Integer, default=0) # Completed HabitLog rows
+    tasks_completed_count = db.Column(db.Integer, default=0) # Tasks currently marked completed
+
+# Case-insensitive prefix search (/api/search_users)
+user_username_lower_index = db.Index('ix_user_username_lower', db.func.lower(User.username))
+
+# Substring search: FTS5 trigram table (SQLite, rowid = user.id, filled on register) or a pg_trgm
+# GIN index (Postgres). Optional; without it search returns prefix matches only.
+USERNAME_SEARCH_DDL = {
+    'sqlite': ["CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5(username, tokenize='trigram')"],
+    'postgresql': ["CREATE EXTENSION IF NOT EXISTS pg_trgm",
+                   'CREATE INDEX IF NOT EXISTS ix_user_username_trgm ON "user" USING gin (lower(username) gin_trgm_ops)'],
+}
+
+def create_username_search(connection):
+    try:
+        with connection.begin_nested():
+            for sql in USERNAME_SEARCH_DDL.get(connection.dialect.name, []):
+                connection.execute(db.text(sql))
+        return True
+    except exc.DBAPIError as e:
+        logger.warning(f"Username substring search unavailable: {e}")
+        return False
+
+@event.listens_for(User.__table__, 'after_create')
+def create_username_search_on_create(target, connection, **kw):
+    create_username_search(connection)
 
 class Friendship(db.Model):
+    __table_args__ = (
+        db.Index('uq_friendship_sender_receiver', 'sender_id', 'receiver_id', unique=True),
+        db.Index('ix_friendship_receiver_status', 'receiver_id', 'status'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -44,7 +136,7 @@ class Friendship(db.Model):
 class Habit(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.String(200), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     
     # Frequency Config
     frequency = db.Column(db.String(20), default='daily') # daily, specific, weekly_flex
@@ -53,22 +145,50 @@ class Habit(db.Model):
     
     # Sharing
     is_shared = db.Column(db.Boolean, default=False)
-    shared_id = db.Column(db.String(36), nullable=True) # UUID to group users contexts
+    shared_id = db.Column(db.String(36), nullable=True, index=True) # UUID to group users contexts
     shared_streak = db.Column(db.Integer, default=0) # Calculated group streak
+    shared_streak_date = db.Column(db.Date, nullable=True) # Last day the rollover job evaluated shared_streak
     
     logs = db.relationship('HabitLog', backref='habit', lazy=True, cascade="all, delete-orphan")
+    stats = db.relationship('HabitStats', uselist=False, lazy=True, cascade="all, delete-orphan")
+    years = db.relationship('HabitYear', lazy=True, cascade="all, delete-orphan")
 
 class HabitLog(db.Model):
+    __table_args__ = (
+        db.Index('uq_habit_log_habit_date', 'habit_id', 'date', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     habit_id = db.Column(db.Integer, db.ForeignKey('habit.id'), nullable=False)
     date = db.Column(db.Date, default=date.today)
     value = db.Column(db.Integer, default=0) 
     completed = db.Column(db.Boolean, default=False)
 
+class HabitStats(db.Model):
+    # Precomputed per-habit statistics, maintained incrementally by toggle_habit
+    habit_id = db.Column(db.Integer, db.ForeignKey('habit.id'), primary_key=True)
+    current_streak = db.Column(db.Integer, default=0) # Run ending at last_completion_date
+    best_streak = db.Column(db.Integer, default=0)
+    best_streak_end = db.Column(db.Date, nullable=True) # Set when a run strictly beats the previous best
+    total_completions = db.Column(db.Integer, default=0)
+    total_logged_days = db.Column(db.Integer, default=0)
+    last_completion_date = db.Column(db.Date, nullable=True)
+
+class HabitYear(db.Model):
+    # Compact copy of a habit's HabitLog rows for one calendar year, kept in sync by record_habit_day.
+    # Bit i of the bitmaps is day i of the year (0 = Jan 1); values holds 366 little-endian uint16.
+    habit_id = db.Column(db.Integer, db.ForeignKey('habit.id'), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    completed = db.Column(db.LargeBinary(46), nullable=False)
+    logged = db.Column(db.LargeBinary(46), nullable=False) # Days that have a HabitLog row
+    values = db.Column(db.LargeBinary(732), nullable=False)
+
 class Task(db.Model):
+    __table_args__ = (
+        db.Index('ix_task_shared_scheduled', 'shared_id', 'scheduled_date'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.String(200), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     created_date = db.Column(db.Date, default=date.today)
     scheduled_date = db.Column(db.Date, default=date.today)
     completed = db.Column(db.Boolean, default=False)
@@ -88,93 +208,405 @@ class Achievement(db.Model):
     threshold = db.Column(db.Integer, nullable=False)
 
 class UserAchievement(db.Model):
+    __table_args__ = (
+        db.Index('uq_user_achievement_user_achievement', 'user_id', 'achievement_id', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     achievement_id = db.Column(db.Integer, db.ForeignKey('achievement.id'), nullable=False)
     date_earned = db.Column(db.Date, default=date.today)
 
+class LeaderboardScore(db.Model):
+    # Leaderboard figures without a User counter, maintained by bump_leaderboard_score;
+    # the streak is read from User.current_streak
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    week_start = db.Column(db.Date, nullable=True) # Monday of the week week_completions belongs to
+    week_completions = db.Column(db.Integer, default=0) # Completed HabitLog rows in that week
+    achievement_count = db.Column(db.Integer, default=0)
+
 class ScreenTimeLog(db.Model):
+    __table_args__ = (
+        db.Index('uq_screen_time_log_user_date', 'user_id', 'date', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     date = db.Column(db.Date, default=date.today)
     minutes = db.Column(db.Integer, default=0)
 
+class ScreenTimeRollup(db.Model):
+    # Weekly/monthly totals of ScreenTimeLog, maintained by bump_screen_time_rollups
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    period = db.Column(db.String(5), primary_key=True) # 'week' (starts Monday) or 'month'
+    period_start = db.Column(db.Date, primary_key=True)
+    total_minutes = db.Column(db.Integer, default=0)
+    days_logged = db.Column(db.Integer, default=0)
+
 # --- FOCUS MODULE MODELS ---
 class AppUsage(db.Model):
+    __table_args__ = (
+        db.Index('uq_app_usage_user_package_date', 'user_id', 'package_name', 'date', unique=True),
+        db.Index('ix_app_usage_user_date', 'user_id', 'date'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     package_name = db.Column(db.String(150), nullable=False)
     usage_minutes = db.Column(db.Integer, default=0)
-    # Using String to match user's provided working code exactly
-    date = db.Column(db.String(20), default=lambda: date.today().isoformat())
+    date = db.Column(db.Date, default=date.today)
 
 class AppLimit(db.Model):
+    __table_args__ = (
+        db.Index('uq_app_limit_user_package', 'user_id', 'package_name', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     package_name = db.Column(db.String(150), nullable=False)
     limit_minutes = db.Column(db.Integer, nullable=False)
 
+class SharedGroupProgress(db.Model):
+    # Per-day members_done/members_total of a shared habit group (date = log day)
+    # or shared task group (date = scheduled_date); see refresh_habit_group/refresh_task_group
+    shared_id = db.Column(db.String(36), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    members_total = db.Column(db.Integer, default=0)
+    members_done = db.Column(db.Integer, default=0)
+
+class StreakRollover(db.Model):
+    # One row per day whose streaks have been rolled over (see run_streak_rollover)
+    day = db.Column(db.Date, primary_key=True)
+    finished_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class IdempotencyKey(db.Model):
+    # Idempotency-Key of a committed mutation; replays from the offline outbox (static/sw.js) are not applied twice
+    __table_args__ = (
+        db.Index('ix_idempotency_key_created_at', 'created_at'),
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    key = db.Column(db.String(64), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SchemaVersion(db.Model):
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
 
 # --- Helpers ---
 def get_start_of_week(d):
     return d - timedelta(days=d.weekday())
 
-def compute_user_state(user):
+class TTLCache:
+    # In-process cache for read-mostly lookups: per-key TTL, LRU eviction, hit/miss counters.
+    # Every worker has its own copy, so only cache values that never change, carry their
+    # version in the stored value, or are invalidated by the routes that write them.
+    def __init__(self, max_entries=1024, default_ttl=300):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict() # key -> (expires_at or None, value)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                if entry is not None: del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        # ttl=None uses the default, ttl=0 keeps the entry until it is invalidated or evicted
+        ttl = self.default_ttl if ttl is None else ttl
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl if ttl else None, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader, ttl=None):
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        # Counters since the worker started; logged once a day by schedule_streak_rollover
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': round(self.hits / lookups, 3) if lookups else None}
+
+cache = TTLCache(max_entries=int(os.environ.get('CACHE_MAX_ENTRIES', 4096)),
+                 default_ttl=int(os.environ.get('CACHE_TTL', 300)))
+
+@login_manager.user_loader
+def load_user(user_id):
+    # Only the immutable columns (id, username, password) are cached; everything else is left
+    # unloaded on the re-attached instance and read from the DB when a request touches it
+    user_id = int(user_id)
+    cached = cache.get(('user', user_id))
+    if cached is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            cache.set(('user', user_id), (user.username, user.password))
+        return user
+    user = User(id=user_id, username=cached[0], password=cached[1])
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+LimitEntry = namedtuple('LimitEntry', ['package_name', 'limit_minutes'])
+
+def load_app_limits(user):
+    # AppLimit rows of a user, cached together with the limits_version they were read at
+    key = ('app_limits', user.id)
+    version = user.limits_version or 0
+    cached = cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    limits = [LimitEntry(p, m) for p, m in db.session.query(AppLimit.package_name, AppLimit.limit_minutes).filter_by(user_id=user.id).all()]
+    cache.set(key, (version, limits))
+    return limits
+
+# One entry per other user: status of the request I sent and of the one I received (None if absent)
+FriendEdge = namedtuple('FriendEdge', ['id', 'username', 'sent', 'received'])
+
+def friend_status(edge):
+    # 'msg', 'pending', 'pending_received' or 'accepted'; a request I sent takes precedence
+    if edge is None: return 'msg'
+    if edge.sent: return edge.sent
+    return 'pending_received' if edge.received == 'pending' else 'accepted'
+
+def load_friend_graph(user):
+    # {other user id: FriendEdge} from one joined query, cached with the friends_version it was read at
+    key = ('friends', user.id)
+    version = user.friends_version or 0
+    cached = cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    other_id = db.case((Friendship.sender_id == user.id, Friendship.receiver_id), else_=Friendship.sender_id)
+    rows = db.session.query(User.id, User.username, Friendship.sender_id, Friendship.status).join(
+        Friendship, User.id == other_id
+    ).filter((Friendship.sender_id == user.id) | (Friendship.receiver_id == user.id)).order_by(Friendship.id).all()
+    graph = {}
+    for other, username, sender_id, status in rows:
+        edge = graph.get(other) or FriendEdge(other, username, None, None)
+        graph[other] = edge._replace(sent=status) if sender_id == user.id else edge._replace(received=status)
+    cache.set(key, (version, graph))
+    return graph
+
+def bump_friends_version(user_ids):
+    # Invalidate the cached friend graph of these users (call before commit)
+    ids = {int(i) for i in user_ids if i}
+    if not ids: return
+    User.query.filter(User.id.in_(ids)).update(
+        {User.friends_version: db.func.coalesce(User.friends_version, 0) + 1}, synchronize_session=False)
+
+class StateNotifier:
+    # In-process pub/sub: long-poll requests wait here until their user's state changes.
+    # Only users with a waiting request are tracked; their entry goes away with the last one.
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._listeners = {} # user_id -> {'version': local change count, 'db_version': state_version, 'waiting': n}
+
+    @contextmanager
+    def listen(self, user_id, db_version):
+        # Yields wait(timeout) -> True once a change for user_id was published after listen() began
+        with self._cond:
+            entry = self._listeners.setdefault(user_id, {'version': 0, 'db_version': db_version, 'waiting': 0})
+            entry['waiting'] += 1
+            seen = entry['version']
+        try:
+            yield lambda timeout: self._wait(entry, seen, timeout)
+        finally:
+            with self._cond:
+                entry['waiting'] -= 1
+                if entry['waiting'] == 0: del self._listeners[user_id]
+
+    def _wait(self, entry, seen, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: entry['version'] != seen, timeout)
+
+    def publish(self, user_ids):
+        with self._cond:
+            entries = [self._listeners[uid] for uid in user_ids if uid in self._listeners]
+            for entry in entries:
+                entry['version'] += 1
+            if entries: self._cond.notify_all()
+
+    def waiting_users(self):
+        with self._cond:
+            return list(self._listeners)
+
+    def observe(self, db_versions):
+        # state_version as read by the watcher; a change we did not publish ourselves came from another worker
+        with self._cond:
+            changed = []
+            for uid, db_version in db_versions:
+                entry = self._listeners.get(uid)
+                if entry is not None and entry['db_version'] != db_version:
+                    entry['db_version'] = db_version
+                    changed.append(uid)
+        self.publish(changed)
+
+state_notifier = StateNotifier()
+
+# Long-polls hold a worker thread each; at most this many per worker, so toggles and page loads
+# always find a free thread. Above the limit /api/state/stream answers at once like a poll.
+STATE_STREAM_MAX = int(os.environ.get('STATE_STREAM_MAX', max(1, int(os.environ.get('GUNICORN_THREADS', 16)) // 2)))
+# Seconds between the watcher's state_version checks for changes made by other workers
+STATE_STREAM_RECHECK = float(os.environ.get('STATE_STREAM_RECHECK', 5))
+state_stream_slots = threading.BoundedSemaphore(STATE_STREAM_MAX)
+_state_watcher = None
+_state_watcher_lock = threading.Lock()
+
+def watch_state_versions():
+    # One query per interval for all users with a waiting long-poll of this worker, however many there are
+    while True:
+        time.sleep(STATE_STREAM_RECHECK)
+        user_ids = state_notifier.waiting_users()
+        if not user_ids: continue
+        try:
+            with app.app_context():
+                rows = db.session.query(User.id, User.state_version).filter(User.id.in_(user_ids)).all()
+                db.session.remove()
+            state_notifier.observe(rows)
+        except Exception as e:
+            logger.error(f"State watcher error: {e}")
+
+def start_state_watcher():
+    # Started by the first long-poll of each worker (threads do not survive gunicorn's fork)
+    global _state_watcher
+    if _state_watcher is not None and _state_watcher.is_alive(): return
+    with _state_watcher_lock:
+        if _state_watcher is not None and _state_watcher.is_alive(): return
+        _state_watcher = threading.Thread(target=watch_state_versions, daemon=True)
+        _state_watcher.start()
+
+@event.listens_for(db.session, 'after_commit')
+def publish_state_changes(session):
+    ids = session.info.pop('state_changed', None)
+    if ids: state_notifier.publish(ids)
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def discard_state_changes(session, previous_transaction):
+    session.info.pop('state_changed', None)
+    session.info.pop('touched', None)
+
+def bump_state_version(user_ids):
+    # Invalidate the /api/state ETag of these users (call before commit)
+    ids = {int(i) for i in user_ids if i}
+    if not ids: return
+    User.query.filter(User.id.in_(ids)).update(
+        {User.state_version: db.func.coalesce(User.state_version, 0) + 1}, synchronize_session=False)
+    # Waiting /api/state/stream requests are woken once the commit succeeds
+    db.session.info.setdefault('state_changed', set()).update(ids)
+
+def touch_entries(habits=(), tasks=()):
+    # Record the current user's habits/tasks a mutation changed; their entries form the response delta
+    touched = db.session.info.setdefault('touched', {'habits': [], 'tasks': []})
+    touched['habits'].extend(habits)
+    touched['tasks'].extend(tasks)
+
+def habit_group_members(shared_id):
+    if not shared_id: return set()
+    return {uid for (uid,) in db.session.query(Habit.user_id).filter_by(shared_id=shared_id).all()}
+
+def task_group_members(shared_id):
+    if not shared_id: return set()
+    return {uid for (uid,) in db.session.query(Task.user_id).filter_by(shared_id=shared_id).all()}
+
+def state_etag(user, version=None):
+    # State also depends on the calendar day (visibility, task tags)
+    version = user.state_version if version is None else version
+    return f"{user.id}-{version or 0}-{date.today().isoformat()}"
+
+def cached_user_state(user):
+    # (etag, state); computed once per state version and shared by the dashboard, /api/state and the stream
+    etag = state_etag(user)
+    cached = cache.get(('state', user.id))
+    if cached is not None and cached[0] == etag:
+        return cached
+    entry = (etag, compute_user_state(user))
+    cache.set(('state', user.id), entry)
+    return entry
+
+def dashboard_fragments(user, etag, state):
+    # Pre-rendered habit/task list markup, cached under the same etag as the state it was rendered from
+    cached = cache.get(('fragments', user.id))
+    if cached is not None and cached[0] == etag:
+        return cached[1]
+    fragments = {
+        'habit_list': get_template_attribute('_dashboard_lists.html', 'habit_list')(state['habits']),
+        'task_list': get_template_attribute('_dashboard_lists.html', 'task_list')(state['tasks']),
+    }
+    cache.set(('fragments', user.id), (etag, fragments))
+    return fragments
+
+def compute_user_state(user, habit_ids=None, task_ids=None):
+    # habit_ids/task_ids restrict the result to those entries (see state_delta)
     today = date.today()
     weekday = str(today.weekday())
-    habits = Habit.query.filter_by(user_id=user.id).all()
-    habit_data = []
-
+    start_week = get_start_of_week(today)
+
+    # Bulk load: habits, then all of this week's logs (covers today) in one IN query
+    habits_query = Habit.query.filter_by(user_id=user.id)
+    if habit_ids is not None:
+        habits_query = habits_query.filter(Habit.id.in_(habit_ids))
+    habits = habits_query.all() if habit_ids is None or habit_ids else []
+    visible = []
     for h in habits:
         # Visibility Check
-        is_visible = False
-        if h.frequency == 'daily': is_visible = True
-        elif h.frequency == 'specific' and weekday in h.days.split(','): is_visible = True
-        elif h.frequency == 'weekly_flex': is_visible = True
-        
-        if not is_visible: continue
+        if h.frequency == 'daily': visible.append(h)
+        elif h.frequency == 'specific' and weekday in h.days.split(','): visible.append(h)
+        elif h.frequency == 'weekly_flex': visible.append(h)
+
+    week_logs = {}
+    if visible:
+        rows = HabitLog.query.filter(HabitLog.habit_id.in_([h.id for h in visible]), HabitLog.date >= start_week).order_by(HabitLog.id).all()
+        for l in rows:
+            week_logs.setdefault(l.habit_id, []).append(l)
 
+    # Shared habits: all member habits joined with today's log in one query
+    group_progress = read_habit_group_progress({h.shared_id for h in visible if h.is_shared and h.shared_id}, today)
+
+    habit_data = []
+    for h in visible:
         # Completion Logic
         completed = False
         current_val = 0
-        
+        logs = week_logs.get(h.id, [])
+
         if h.frequency == 'weekly_flex':
-            start_week = get_start_of_week(today)
-            logs = HabitLog.query.filter(HabitLog.habit_id==h.id, HabitLog.date >= start_week).all()
-            total_val = sum(l.value for l in logs)
-            current_val = total_val
+            current_val = sum(l.value for l in logs)
             if current_val >= h.target:
                 completed = True
         else:
-            log = HabitLog.query.filter_by(habit_id=h.id, date=today).first()
+            log = next((l for l in logs if l.date == today), None)
             if log:
                 current_val = log.value
                 completed = log.completed
 
         if h.is_shared:
             # Shared logic: Check if ALL group members have completed it for today
-            group_members_habits = Habit.query.filter_by(shared_id=h.shared_id).all()
-            all_members_ready = True
-            
-            # For progress reporting, we might want to see how many are done
-            members_done = 0
-            total_members = len(group_members_habits)
-            
-            for mh in group_members_habits:
-                m_log = HabitLog.query.filter_by(habit_id=mh.id, date=today).first()
-                if m_log and m_log.completed:
-                    members_done += 1
-                else:
-                    all_members_ready = False
-            
+            members_done, total_members = group_progress.get(h.shared_id, (0, 0))
+
             # The habit is only "COMPLETED" for the dashboard if EVERYONE is done
-            if not all_members_ready:
+            if members_done < total_members:
                 completed = False
                 shared_info = f"({members_done}/{total_members})"
             else:
@@ -194,8 +626,11 @@ def compute_user_state(user):
         })
         
     # --- Task Logic ---
-    tasks_query = Task.query.filter_by(user_id=user.id).all()
-    task_data = []
+    tasks_query = Task.query.filter_by(user_id=user.id)
+    if task_ids is not None:
+        tasks_query = tasks_query.filter(Task.id.in_(task_ids))
+    tasks_query = tasks_query.all() if task_ids is None or task_ids else []
+    visible_tasks = []
     
     for t in tasks_query:
         # Expiration Logic
@@ -219,7 +654,13 @@ def compute_user_state(user):
             delta = (today - s_date).days
             if delta > 3:
                 continue # Expired/Delete
-        
+        visible_tasks.append((t, s_date))
+
+    # Shared tasks: every member copy of every visible group in one query
+    task_progress = read_task_group_progress({t.shared_id for t, _ in visible_tasks if t.is_shared and t.shared_id})
+
+    task_data = []
+    for t, s_date in visible_tasks:
         # Determine label (e.g. "Yesterday")
         tag = ""
         days_diff = (today - s_date).days
@@ -231,18 +672,9 @@ def compute_user_state(user):
         
         # If shared, check if GLOBAL group is done
         if t.is_shared:
-            group_members_tasks = Task.query.filter_by(shared_id=t.shared_id, scheduled_date=t.scheduled_date).all()
-            all_members_ready = True
-            members_done = 0
-            total_members = len(group_members_tasks)
-            
-            for mt in group_members_tasks:
-                if mt.completed:
-                    members_done += 1
-                else:
-                    all_members_ready = False
+            members_done, total_members = task_progress.get((t.shared_id, t.scheduled_date), (0, 0))
             
-            if not all_members_ready:
+            if members_done < total_members:
                 completed = False
                 tag = f"({members_done}/{total_members}) " + tag
             else:
@@ -267,12 +699,342 @@ def compute_user_state(user):
         'streak': user.current_streak
     }
 
-def check_group_streak_logic(shared_id):
-    pass 
+def state_delta(user, touched):
+    # The entries of the touched habits/tasks as /api/state would show them; ids that are gone or
+    # no longer visible today are listed as removed
+    habit_ids = touched.get('habits', set())
+    task_ids = touched.get('tasks', set())
+    data = compute_user_state(user, habit_ids=habit_ids, task_ids=task_ids)
+    return {
+        'habits': data['habits'],
+        'tasks': data['tasks'],
+        'removed_habits': sorted(habit_ids - {h['id'] for h in data['habits']}),
+        'removed_tasks': sorted(task_ids - {t['id'] for t in data['tasks']}),
+        'streak': data['streak'],
+    }
+
+def load_shared_habit_progress(shared_ids, day):
+    # Returns {shared_id: (members_done, total_members)} for the given day in a single query
+    if not shared_ids: return {}
+    rows = db.session.query(Habit.id, Habit.shared_id, HabitLog.completed).outerjoin(
+        HabitLog, (HabitLog.habit_id == Habit.id) & (HabitLog.date == day)
+    ).filter(Habit.shared_id.in_(shared_ids)).order_by(Habit.id, HabitLog.id).all()
+
+    member_done = {}
+    for habit_id, shared_id, completed in rows:
+        # First log per member wins (matches the old .first() lookup)
+        if habit_id not in member_done:
+            member_done[habit_id] = (shared_id, bool(completed))
+
+    progress = {}
+    for shared_id, done in member_done.values():
+        d, total = progress.get(shared_id, (0, 0))
+        progress[shared_id] = (d + (1 if done else 0), total + 1)
+    return progress
+
+def load_shared_task_progress(shared_ids):
+    # Returns {(shared_id, scheduled_date): (members_done, total_members)} in a single query
+    if not shared_ids: return {}
+    rows = db.session.query(Task.shared_id, Task.scheduled_date, Task.completed).filter(Task.shared_id.in_(shared_ids)).all()
+    progress = {}
+    for shared_id, s_date, completed in rows:
+        d, total = progress.get((shared_id, s_date), (0, 0))
+        progress[(shared_id, s_date)] = (d + (1 if completed else 0), total + 1)
+    return progress
+
+def read_habit_group_progress(shared_ids, day):
+    # One aggregate lookup; groups nobody toggled yet today fall back to the raw member logs
+    if not shared_ids: return {}
+    progress = {p.shared_id: (p.members_done, p.members_total) for p in SharedGroupProgress.query.filter(
+        SharedGroupProgress.shared_id.in_(shared_ids), SharedGroupProgress.date == day).all()}
+    missing = set(shared_ids) - set(progress)
+    if missing:
+        progress.update(load_shared_habit_progress(missing, day))
+    return progress
+
+def read_task_group_progress(shared_ids):
+    if not shared_ids: return {}
+    progress = {(p.shared_id, p.date): (p.members_done, p.members_total) for p in SharedGroupProgress.query.filter(
+        SharedGroupProgress.shared_id.in_(shared_ids)).all()}
+    missing = set(shared_ids) - {sid for sid, _ in progress}
+    if missing:
+        progress.update(load_shared_task_progress(missing))
+    return progress
+
+def upsert(model, rows, index_elements, set_, where=None):
+    # INSERT ... ON CONFLICT (index_elements) DO UPDATE for a list of row dicts (call before commit).
+    # set_(table, new) and where(table, new) build the update from the stored row (table.c) and the
+    # proposed one (new: the EXCLUDED row, or the row's values where the dialect has no ON CONFLICT).
+    if not rows: return
+    table = model.__table__
+    dialect = db.engine.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(index_elements=index_elements, set_=set_(table, stmt.excluded),
+                                          where=where(table, stmt.excluded) if where else None)
+        db.session.execute(stmt, rows)
+        return
+
+    for row in rows:
+        new = SimpleNamespace(**{name: db.literal(value, table.c[name].type) for name, value in row.items()})
+        key = [table.c[name] == row[name] for name in index_elements]
+        if db.session.execute(db.select(db.literal(1)).select_from(table).where(*key)).first() is None:
+            db.session.execute(db.insert(table).values(row))
+        else:
+            condition = [where(table, new)] if where else []
+            db.session.execute(db.update(table).where(*key, *condition).values(set_(table, new)))
+
+def save_group_progress(rows):
+    # Upsert [(shared_id, date, members_done, members_total)] in one statement
+    upsert(SharedGroupProgress,
+           [{'shared_id': sid, 'date': day, 'members_done': done, 'members_total': total} for sid, day, done, total in rows],
+           ['shared_id', 'date'],
+           lambda table, new: {'members_done': new.members_done, 'members_total': new.members_total})
+
+def refresh_habit_group(shared_id, day):
+    # Recount one group/day after a write to it (call before commit)
+    if not shared_id: return
+    db.session.flush()
+    done, total = load_shared_habit_progress({shared_id}, day).get(shared_id, (0, 0))
+    save_group_progress([(shared_id, day, done, total)])
+
+def refresh_task_group(shared_id, day):
+    if not shared_id: return
+    db.session.flush()
+    done, total = load_shared_task_progress({shared_id}).get((shared_id, day), (0, 0))
+    save_group_progress([(shared_id, day, done, total)])
+
+def check_group_progress(repair=False):
+    # Consistency checker: recount every stored aggregate with the functions of the write path
+    # (refresh_habit_group/refresh_task_group) and report (or rewrite) the ones that differ.
+    # A missing row is never drift, reads fall back to the same count; an all-zero row equals a missing one.
+    # Past habit days are skipped: their members_total is the group as it was that day.
+    today = date.today()
+    stored = SharedGroupProgress.query.all()
+    habit_groups = {sid for (sid,) in db.session.query(Habit.shared_id).filter(Habit.shared_id.is_not(None)).distinct()}
+    task_groups = {sid for (sid,) in db.session.query(Task.shared_id).filter(Task.shared_id.is_not(None)).distinct()}
+    habits_today = load_shared_habit_progress(habit_groups, today)
+    tasks = load_shared_task_progress(task_groups)
+
+    mismatches = []
+    for entry in stored:
+        key = (entry.shared_id, entry.date)
+        if entry.shared_id in task_groups:
+            expected = tasks.get(key, (0, 0))
+        elif entry.date < today:
+            continue
+        elif entry.date == today:
+            expected = habits_today.get(entry.shared_id, (0, 0))
+        else:
+            expected = (0, 0)
+        if ((entry.members_done or 0), (entry.members_total or 0)) != expected:
+            mismatches.append((key, (entry.members_done, entry.members_total), expected))
+    if repair:
+        save_group_progress([(sid, day, done, total) for (sid, day), _, (done, total) in mismatches])
+    return mismatches
+
+def active_streak(stats, today):
+    # A run only counts while its last completion is today or yesterday
+    if stats.last_completion_date and stats.last_completion_date >= today - timedelta(days=1):
+        return stats.current_streak or 0
+    return 0
+
+def update_habit_stats(habit, today, created, was_completed, now_completed):
+    # O(1) update for a change to today's log; toggles never touch older days
+    db.session.flush()
+    stats = habit.stats
+    if stats is None:
+        # First toggle since stats existed: build from the (already flushed) logs
+        rebuild_habit_stats([habit.id])
+        return
+
+    if created:
+        stats.total_logged_days = (stats.total_logged_days or 0) + 1
+    if now_completed == was_completed:
+        return
+
+    if now_completed:
+        stats.total_completions = (stats.total_completions or 0) + 1
+        if stats.last_completion_date != today:
+            extends = stats.last_completion_date == today - timedelta(days=1)
+            stats.current_streak = (stats.current_streak or 0) + 1 if extends else 1
+            stats.last_completion_date = today
+        if stats.current_streak > (stats.best_streak or 0):
+            stats.best_streak = stats.current_streak
+            stats.best_streak_end = today
+    else:
+        stats.total_completions = max(0, (stats.total_completions or 0) - 1)
+        if stats.last_completion_date == today:
+            if stats.best_streak_end == today:
+                # Today's run was the unique best, so the best shrinks with it
+                stats.best_streak = stats.current_streak - 1
+                stats.best_streak_end = today - timedelta(days=1) if stats.best_streak else None
+            stats.current_streak = (stats.current_streak or 1) - 1
+            if stats.current_streak:
+                stats.last_completion_date = today - timedelta(days=1)
+            else:
+                stats.last_completion_date = db.session.query(db.func.max(HabitLog.date)).filter(
+                    HabitLog.habit_id == habit.id, HabitLog.completed == True, HabitLog.date < today).scalar()
+
+def rebuild_habit_stats(habit_ids=None, chunk_size=500):
+    # Recomputes HabitStats from raw logs (backfill / repair); returns {habit_id: stats} for the given ids
+    if habit_ids is None:
+        habit_ids = [hid for (hid,) in db.session.query(Habit.id).order_by(Habit.id).all()]
+    rebuilt = {}
+    for i in range(0, len(habit_ids), chunk_size):
+        chunk = habit_ids[i:i + chunk_size]
+        existing = {s.habit_id: s for s in HabitStats.query.filter(HabitStats.habit_id.in_(chunk)).all()}
+        for hid in chunk:
+            stats = existing.get(hid)
+            if stats is None:
+                stats = HabitStats(habit_id=hid)
+                db.session.add(stats)
+            stats.current_streak = stats.best_streak = stats.total_completions = stats.total_logged_days = 0
+            stats.best_streak_end = stats.last_completion_date = None
+            rebuilt[hid] = stats
+
+        rows = db.session.query(HabitLog.habit_id, HabitLog.date, HabitLog.completed).filter(
+            HabitLog.habit_id.in_(chunk)).order_by(HabitLog.habit_id, HabitLog.date).all()
+        for hid, d, completed in rows:
+            stats = rebuilt[hid]
+            stats.total_logged_days += 1
+            if not completed or d is None: continue
+            stats.total_completions += 1
+            extends = stats.last_completion_date == d - timedelta(days=1)
+            stats.current_streak = stats.current_streak + 1 if extends else 1
+            stats.last_completion_date = d
+            if stats.current_streak > stats.best_streak:
+                stats.best_streak = stats.current_streak
+                stats.best_streak_end = d
+        db.session.flush()
+    return rebuilt
+
+# --- Completion bitmaps ---
+# Day sets are Python ints used as bitsets (bit i = i days after the timeline start), so runs,
+# windows and weekday counts are a handful of whole-int operations instead of a loop over log rows.
+
+YEAR_DAYS = 366
+YEAR_BITS_BYTES = (YEAR_DAYS + 7) // 8
+VALUES_FORMAT = f'<{YEAR_DAYS}H'
+EMPTY_VALUES = struct.pack(VALUES_FORMAT, *([0] * YEAR_DAYS))
+
+HabitTimeline = namedtuple('HabitTimeline', ['start', 'days', 'completed', 'logged', 'values'])
+
+def popcount(bits):
+    return bin(bits).count('1') # int.bit_count needs Python 3.10
+
+def bits_window(bits, first, last):
+    # Bits first..last (inclusive), shifted down to bit 0
+    if last < first: return 0
+    return (bits >> first) & ((1 << (last - first + 1)) - 1)
+
+def longest_run(bits):
+    # Each step shortens every run by one, so the number of steps is the longest run
+    n = 0
+    while bits:
+        bits &= bits >> 1
+        n += 1
+    return n
+
+def trailing_run(bits, end):
+    # Length of the run of set bits ending at bit `end`
+    if end < 0: return 0
+    mask = (1 << (end + 1)) - 1
+    return end + 1 - (~bits & mask).bit_length()
+
+@lru_cache(maxsize=64)
+def weekday_masks(start_weekday, days):
+    # One mask per weekday (0 = Monday) over a timeline of `days` bits starting on start_weekday
+    every_week = sum(1 << (7 * k) for k in range(days // 7 + 1))
+    full = (1 << days) - 1
+    return tuple(((every_week << ((w - start_weekday) % 7)) & full) for w in range(7))
+
+def weekday_rates(timeline):
+    # Share of each weekday (Monday first) in the timeline on which the habit was completed
+    masks = weekday_masks(timeline.start.weekday(), timeline.days)
+    return [round(popcount(timeline.completed & m) / popcount(m), 3) if m else 0 for m in masks]
+
+def load_habit_timeline(habit_id, start, end):
+    # Completion/logged bitsets and values for start..end from the HabitYear rows (one query)
+    days = (end - start).days + 1
+    completed = logged = 0
+    values = [0] * days
+    for row in HabitYear.query.filter(HabitYear.habit_id == habit_id, HabitYear.year.between(start.year, end.year)).all():
+        offset = (date(row.year, 1, 1) - start).days
+        year_completed = int.from_bytes(row.completed, 'little')
+        year_logged = int.from_bytes(row.logged, 'little')
+        if offset >= 0:
+            completed |= year_completed << offset
+            logged |= year_logged << offset
+        else:
+            completed |= year_completed >> -offset
+            logged |= year_logged >> -offset
+        # Slot 365 of a non-leap year is unused and would overlap the next year's Jan 1
+        year_days = (date(row.year + 1, 1, 1) - date(row.year, 1, 1)).days
+        first, last = max(0, -offset), min(year_days, days - offset)
+        if first < last:
+            values[first + offset:last + offset] = struct.unpack(VALUES_FORMAT, row.values)[first:last]
+    full = (1 << days) - 1
+    return HabitTimeline(start, days, completed & full, logged & full, values)
+
+def record_habit_day(habit_id, day, value, completed):
+    # Mirror a HabitLog write into its HabitYear row (call before commit)
+    row = db.session.get(HabitYear, (habit_id, day.year), with_for_update=True)
+    if row is None:
+        row = HabitYear(habit_id=habit_id, year=day.year, completed=bytes(YEAR_BITS_BYTES),
+                        logged=bytes(YEAR_BITS_BYTES), values=EMPTY_VALUES)
+        db.session.add(row)
+    i = (day - date(day.year, 1, 1)).days
+    bit = 1 << i
+    year_completed = int.from_bytes(row.completed, 'little')
+    year_completed = year_completed | bit if completed else year_completed & ~bit
+    row.completed = year_completed.to_bytes(YEAR_BITS_BYTES, 'little')
+    row.logged = (int.from_bytes(row.logged, 'little') | bit).to_bytes(YEAR_BITS_BYTES, 'little')
+    values = list(struct.unpack(VALUES_FORMAT, row.values))
+    values[i] = min(max(value or 0, 0), 0xFFFF)
+    row.values = struct.pack(VALUES_FORMAT, *values)
+
+def rebuild_habit_years(habit_ids=None, chunk_size=500):
+    # Recomputes HabitYear rows from raw logs (backfill / repair); returns the number of rows written
+    if habit_ids is None:
+        habit_ids = [hid for (hid,) in db.session.query(Habit.id).order_by(Habit.id).all()]
+    written = 0
+    for i in range(0, len(habit_ids), chunk_size):
+        chunk = habit_ids[i:i + chunk_size]
+        HabitYear.query.filter(HabitYear.habit_id.in_(chunk)).delete(synchronize_session=False)
+        years = {}
+        rows = db.session.query(HabitLog.habit_id, HabitLog.date, HabitLog.value, HabitLog.completed).filter(
+            HabitLog.habit_id.in_(chunk), HabitLog.date.is_not(None)).all()
+        for hid, d, value, completed in rows:
+            entry = years.setdefault((hid, d.year), [0, 0, [0] * YEAR_DAYS])
+            i = (d - date(d.year, 1, 1)).days
+            if completed: entry[0] |= 1 << i
+            entry[1] |= 1 << i
+            entry[2][i] = min(max(value or 0, 0), 0xFFFF)
+        db.session.bulk_insert_mappings(HabitYear, [
+            {'habit_id': hid, 'year': year, 'completed': c.to_bytes(YEAR_BITS_BYTES, 'little'),
+             'logged': l.to_bytes(YEAR_BITS_BYTES, 'little'), 'values': struct.pack(VALUES_FORMAT, *v)}
+            for (hid, year), (c, l, v) in years.items()])
+        db.session.flush()
+        written += len(years)
+    return written
+
+def lazy_context(name, loader):
+    # Template value that is only computed when a template actually uses it, once per request
+    def resolve():
+        key = '_lazy_' + name
+        if key not in g:
+            setattr(g, key, loader())
+        return getattr(g, key)
+    return LocalProxy(resolve)
 
 @app.context_processor
 def inject_calendar():
-    today = date.today()
+    return {'week_calendar': lazy_context('week_calendar', lambda: cache.get_or_load(
+        ('week_calendar', date.today()), lambda: build_week_calendar(date.today()), ttl=86400))}
+
+def build_week_calendar(today):
     # Get start of current week (Monday)
     start = today - timedelta(days=today.weekday())
     week_dates = []
@@ -285,30 +1047,60 @@ def inject_calendar():
             'is_today': d == today,
             'date_str': d.strftime('%Y-%m-%d')
         })
-    return {'week_calendar': week_dates}
+    return week_dates
 
 @app.context_processor
 def inject_version():
+    return {'version': lazy_context('version', lambda: cache.get_or_load(('version',), read_version, ttl=60))}
+
+def read_version():
     try:
         with open('version.txt', 'r') as f:
-            version = f.read().strip()
+            return f.read().strip()
     except:
-        version = '1.0.0'
-    return {'version': version}
+        return '1.0.0'
 
 # --- Routes ---
 
+@app.before_request
+def check_mutation_user():
+    # Pages send the id of their user with each mutation (X-Habitflow-User). Replays from the offline outbox
+    # (static/sw.js) keep it, so after an account switch they are rejected instead of running as the new user.
+    sender = request.headers.get('X-Habitflow-User')
+    if request.method != 'POST' or not sender or not current_user.is_authenticated: return
+    if sender != str(current_user.id):
+        return jsonify({'success': False, 'message': 'Sent by another user'}), 409
+
+@app.before_request
+def claim_idempotency_key():
+    # The key is added to the route's own transaction, so it is only recorded if the mutation commits
+    key = request.headers.get('Idempotency-Key')
+    if request.method != 'POST' or not key or not current_user.is_authenticated: return
+    key = key[:64]
+    if db.session.get(IdempotencyKey, (current_user.id, key)) is not None:
+        return jsonify({'success': True, 'duplicate': True})
+    db.session.add(IdempotencyKey(user_id=current_user.id, key=key))
+
+def prune_idempotency_keys(max_age_days=7):
+    # Outbox replays happen within days; older keys are no longer needed
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    deleted = IdempotencyKey.query.filter(IdempotencyKey.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
 @app.route('/')
 @login_required
 def index():
-    data = compute_user_state(current_user)
-    
+    etag, data = cached_user_state(current_user)
+    fragments = dashboard_fragments(current_user, etag, data)
+
     # German Date Helper
     now = datetime.now()
     months = ["Jan", "Feb", "Mär", "Apr", "Mai", "Jun", "Jul", "Aug", "Sep", "Okt", "Nov", "Dez"]
     german_date = f"{now.day}. {months[now.month-1]}"
     
-    return render_template('index.html', user=current_user, habits=data['habits'], tasks=data['tasks'], streak=data['streak'], now=now, german_date=german_date)
+    return render_template('index.html', user=current_user, state=data, state_etag=etag, fragments=fragments,
+                           habits=data['habits'], tasks=data['tasks'], streak=data['streak'], now=now, german_date=german_date)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -333,6 +1125,8 @@ def register():
             hashed = generate_password_hash(password, method='pbkdf2:sha256')
             new_user = User(username=username, password=hashed)
             db.session.add(new_user)
+            db.session.flush()
+            index_username(new_user)
             db.session.commit()
             login_user(new_user)
             return redirect(url_for('index'))
@@ -385,9 +1179,9 @@ def achievements_page():
 @login_required
 def handyzeit():
     today = date.today()
-    log = ScreenTimeLog.query.filter_by(user_id=current_user.id, date=today).first()
     
     if request.method == 'POST':
+        log = ScreenTimeLog.query.filter_by(user_id=current_user.id, date=today).first()
         action = request.form.get('action')
         if action == 'update_limit':
             new_limit = int(request.form.get('limit'))
@@ -396,89 +1190,378 @@ def handyzeit():
             flash('Tageslimit aktualisiert.')
         elif action == 'add_time':
             minutes = int(request.form.get('minutes'))
+            created = not log
             if not log:
                 log = ScreenTimeLog(user_id=current_user.id, date=today, minutes=0)
                 db.session.add(log)
             log.minutes += minutes
+            bump_screen_time_rollups(current_user.id, today, minutes, 1 if created else 0)
             db.session.commit()
             flash(f'{minutes} Minuten hinzugefügt.')
         elif action == 'set_time':
              minutes = int(request.form.get('minutes'))
+             created = not log
              if not log:
                 log = ScreenTimeLog(user_id=current_user.id, date=today, minutes=0)
                 db.session.add(log)
+             bump_screen_time_rollups(current_user.id, today, minutes - (log.minutes or 0), 1 if created else 0)
              log.minutes = minutes
              db.session.commit()
              flash('Zeit aktualisiert.')
         
         return redirect(url_for('handyzeit'))
 
-    if not log:
-        current_usage = 0
-    else:
-        current_usage = log.minutes
+    # History (Last 7 days, today included) in one range query
+    by_day = screen_time_by_day(current_user.id, today - timedelta(days=6), today)
+    current_usage = by_day.get(today, 0)
         
     limit = current_user.screen_time_limit if current_user.screen_time_limit else 120
     percentage = min(100, int((current_usage / limit) * 100)) if limit > 0 else 100
     
-    # History (Last 7 days)
     history = []
     days_de = ['Mo', 'Di', 'Mi', 'Do', 'Fr', 'Sa', 'So']
     for i in range(6, -1, -1):
         d = today - timedelta(days=i)
-        l = ScreenTimeLog.query.filter_by(user_id=current_user.id, date=d).first()
-        val = l.minutes if l else 0
         history.append({
             'day': days_de[d.weekday()],
-            'val': val,
+            'val': by_day.get(d, 0),
             'date': d.strftime('%d.%m.')
         })
 
     return render_template('handyzeit.html', usage=current_usage, limit=limit, percentage=percentage, history=history)
 
-
+def screen_time_by_day(user_id, start, end):
+    # {date: minutes} for [start, end] in one grouped range query (days without a log are absent)
+    rows = db.session.query(ScreenTimeLog.date, db.func.sum(ScreenTimeLog.minutes)).filter(
+        ScreenTimeLog.user_id == user_id, ScreenTimeLog.date >= start, ScreenTimeLog.date <= end
+    ).group_by(ScreenTimeLog.date).all()
+    return {d: int(m or 0) for d, m in rows}
+
+def rollup_periods(day):
+    return [('week', get_start_of_week(day)), ('month', day.replace(day=1))]
+
+def bump_screen_time_rollups(user_id, day, minutes_delta, days_delta):
+    # Add a change of one day's ScreenTimeLog to its week and month rollup (call before commit)
+    if not minutes_delta and not days_delta: return
+    rows = [{'user_id': user_id, 'period': period, 'period_start': start, 'total_minutes': minutes_delta, 'days_logged': days_delta}
+            for period, start in rollup_periods(day)]
+    upsert(ScreenTimeRollup, rows, ['user_id', 'period', 'period_start'],
+           lambda table, new: {'total_minutes': table.c.total_minutes + new.total_minutes,
+                               'days_logged': table.c.days_logged + new.days_logged})
+
+def rebuild_screen_time_rollups(chunk_size=5000):
+    # Recompute all rollups from ScreenTimeLog (migration backfill and rebuild-stats)
+    ScreenTimeRollup.query.delete()
+    totals = {}
+    rows = db.session.query(ScreenTimeLog.user_id, ScreenTimeLog.date, ScreenTimeLog.minutes).yield_per(chunk_size)
+    for user_id, day, minutes in rows:
+        for period, start in rollup_periods(day):
+            total, days = totals.get((user_id, period, start), (0, 0))
+            totals[(user_id, period, start)] = (total + (minutes or 0), days + 1)
+    db.session.bulk_insert_mappings(ScreenTimeRollup, [
+        {'user_id': u, 'period': p, 'period_start': s, 'total_minutes': t, 'days_logged': n}
+        for (u, p, s), (t, n) in totals.items()])
+    db.session.flush()
+    return len(totals)
 
 # --- API ---
 
+@app.route('/api/screen_time')
+@login_required
+def screen_time_history():
+    # ?from=&to= (ISO dates, default last 30 days): daily minutes (ranges up to a year) plus weekly and
+    # monthly rollups, so long-range trends cost two indexed queries regardless of the range
+    today = date.today()
+    try:
+        range_to = date.fromisoformat(request.args['to']) if request.args.get('to') else today
+        range_from = date.fromisoformat(request.args['from']) if request.args.get('from') else range_to - timedelta(days=29)
+    except ValueError:
+        return jsonify({'error': 'Invalid date'}), 400
+    if range_from > range_to or (range_to - range_from).days >= 3660:
+        return jsonify({'error': 'Invalid range'}), 400
+
+    result = {'from': range_from.isoformat(), 'to': range_to.isoformat(), 'weeks': [], 'months': []}
+    if (range_to - range_from).days < 366:
+        by_day = screen_time_by_day(current_user.id, range_from, range_to)
+        result['days'] = [{'date': (range_from + timedelta(days=i)).isoformat(), 'minutes': by_day.get(range_from + timedelta(days=i), 0)}
+                          for i in range((range_to - range_from).days + 1)]
+
+    rollups = ScreenTimeRollup.query.filter(
+        ScreenTimeRollup.user_id == current_user.id,
+        ScreenTimeRollup.period_start >= min(get_start_of_week(range_from), range_from.replace(day=1)),
+        ScreenTimeRollup.period_start <= range_to
+    ).order_by(ScreenTimeRollup.period_start).all()
+    for r in rollups:
+        # Periods that start before the range are only included if they overlap it
+        if r.period == 'week' and r.period_start < get_start_of_week(range_from): continue
+        if r.period == 'month' and r.period_start < range_from.replace(day=1): continue
+        result['weeks' if r.period == 'week' else 'months'].append({
+            'start': r.period_start.isoformat(),
+            'total': r.total_minutes or 0,
+            'days_logged': r.days_logged or 0,
+            'average': round((r.total_minutes or 0) / r.days_logged) if r.days_logged else 0
+        })
+    return jsonify(result)
+
 @app.route('/api/state')
 @login_required
 def get_state():
-    return jsonify(compute_user_state(current_user))
+    etag = state_etag(current_user)
+    if request.if_none_match.contains(etag):
+        return '', 304, {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
 
-@app.route('/api/add_habit', methods=['POST'])
+    etag, data = cached_user_state(current_user)
+    response = jsonify(data)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/state/stream')
 @login_required
-def add_habit():
-    try:
-        data = request.json
-        text = data.get('text')
-        target = int(data.get('target', 1))
-        frequency = data.get('frequency', 'daily')
-        days = data.get('days', [])
-        friend_ids = data.get('friends', []) # List of user IDs to share with
+def stream_state():
+    # Long-poll: hold the request until this user's state changes (or timeout), then answer like /api/state
+    user_id = current_user.id
+    version = current_user.state_version
+    etag = state_etag(current_user)
+    if request.if_none_match.contains(etag):
+        if not state_stream_slots.acquire(blocking=False):
+            return '', 304, {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache', 'Retry-After': '2'}
+        try:
+            timeout = min(max(request.args.get('timeout', 25, type=float), 0), 55)
+            start_state_watcher()
+            # Commits in this process wake us at once, those of other workers via watch_state_versions
+            with state_notifier.listen(user_id, version) as wait:
+                # Release the DB connection while idle
+                db.session.close()
+                wait(timeout)
+        finally:
+            state_stream_slots.release()
+        user = db.session.get(User, user_id)
+        etag = state_etag(user)
+        if request.if_none_match.contains(etag):
+            return '', 304, {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    else:
+        user = current_user
+
+    etag, data = cached_user_state(user)
+    response = jsonify(data)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+class MutationRejected(Exception):
+    # An operation the user may not perform; routes answer it with {'success': False, 'message'} and a 4xx status
+    def __init__(self, message='Invalid request', status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def rejected_response(e):
+    return jsonify({'success': False, 'message': e.message}), e.status
+
+def owned_entry(model, entry_id, user):
+    # The user's own habit/task: 404 for an unknown id, 403 for someone else's
+    entry = model.query.get(entry_id) if entry_id is not None else None
+    if entry is None: raise MutationRejected('Not found', 404)
+    if entry.user_id != user.id: raise MutationRejected('Unauthorized', 403)
+    return entry
+
+# The apply_* functions stage one mutation for the current user without committing and return the
+# achievement condition types it may have advanced; the routes and /api/batch commit and evaluate them.
+
+def apply_add_habit(user, data):
+    text = data.get('text')
+    target = int(data.get('target', 1))
+    frequency = data.get('frequency', 'daily')
+    days = data.get('days', [])
+    friend_ids = data.get('friends', []) # List of user IDs to share with
+    
+    if not text: raise MutationRejected('Text required')
+
+    if frequency == 'specific':
+        days_str = ",".join(map(str, days))
+    else:
+        days_str = "0,1,2,3,4,5,6" # Default
+
+    shared_id = None
+    is_shared = len(friend_ids) > 0
+    if is_shared:
+        shared_id = str(uuid.uuid4())
+        
+    # Create for self
+    me_habit = Habit(text=text, user_id=user.id, target=target, frequency=frequency, days=days_str, is_shared=is_shared, shared_id=shared_id)
+    db.session.add(me_habit)
+    
+    # Create for friends
+    for fid in friend_ids:
+        # Verify friendship exists? Skipped for MVP speed, assuming UI provides valid IDs
+        f_habit = Habit(text=text, user_id=fid, target=target, frequency=frequency, days=days_str, is_shared=True, shared_id=shared_id)
+        db.session.add(f_habit)
+        
+    adjust_counter([user.id] + friend_ids, 'habits_created_count', 1)
+    refresh_habit_group(shared_id, date.today())
+    bump_state_version([user.id] + friend_ids)
+    touch_entries(habits=[me_habit])
+    return {'habits_created'}
+
+def apply_add_task(user, data):
+    text = data.get('text')
+    date_offset = int(data.get('offset', 0)) # 0 = today, 1 = tomorrow ...
+    friend_ids = data.get('friends', [])
+    
+    if not text: raise MutationRejected('Text required')
+    
+    s_date = date.today() + timedelta(days=date_offset)
+    
+    shared_id = None
+    is_shared = len(friend_ids) > 0
+    if is_shared:
+        shared_id = str(uuid.uuid4())
+
+    # Create for self
+    t = Task(text=text, user_id=user.id, scheduled_date=s_date, is_shared=is_shared, shared_id=shared_id)
+    db.session.add(t)
+
+    # Create for friends
+    for fid in friend_ids:
+        f_task = Task(text=text, user_id=fid, scheduled_date=s_date, is_shared=True, shared_id=shared_id)
+        db.session.add(f_task)
+
+    refresh_task_group(shared_id, s_date)
+    bump_state_version([user.id] + friend_ids)
+    touch_entries(tasks=[t])
+    return set()
+
+def apply_toggle_habit(user, data, reset=True):
+    # reset=False (batch 'increment_habit') only counts up and leaves a completed day as it is
+    habit = owned_entry(Habit, data.get('id'), user)
+    
+    today = date.today()
+    created = False
+    
+    if habit.frequency == 'weekly_flex':
+         # Logic for weekly: Just add a log for today with +1 value
+         log = HabitLog.query.filter_by(habit_id=habit.id, date=today).first()
+         if not log:
+             log = HabitLog(habit_id=habit.id, date=today, value=0)
+             db.session.add(log)
+             created = True
+         was_completed = bool(log.completed)
+         
+         # Check total for week
+         start_week = get_start_of_week(today)
+         logs_week = HabitLog.query.filter(HabitLog.habit_id==habit.id, HabitLog.date >= start_week).all()
+         total = sum(l.value for l in logs_week)
+         
+         # If strictly toggling:
+         # Complex logic: If we assume UI sends "do it", we increment.
+         # If user spams click, we assume they want to add reps.
+         # But if completed, maybe we don't toggle off for weekly?
+         # Let's keep simple: Increment
+         log.value += 1
+         # Recalc total
+         if (total + 1) >= habit.target:
+             # Mark all logs this week as completed? Or just conceptual?
+             pass 
+    else:
+        log = HabitLog.query.filter_by(habit_id=habit.id, date=today).first()
+        if not log:
+            log = HabitLog(habit_id=habit.id, date=today, value=0, completed=False)
+            db.session.add(log)
+            created = True
+        was_completed = bool(log.completed)
         
-        if frequency == 'specific':
-            days_str = ",".join(map(str, days))
+        if log.completed:
+            if not reset:
+                touch_entries(habits=[habit])
+                return set()
+            log.completed = False
+            log.value = 0
         else:
-            days_str = "0,1,2,3,4,5,6" # Default
-
-        shared_id = None
-        is_shared = len(friend_ids) > 0
-        if is_shared:
-            shared_id = str(uuid.uuid4())
-            
-        # Create for self
-        me_habit = Habit(text=text, user_id=current_user.id, target=target, frequency=frequency, days=days_str, is_shared=is_shared, shared_id=shared_id)
-        db.session.add(me_habit)
+            log.value += 1
+            if log.value >= habit.target:
+                log.value = habit.target
+                log.completed = True
+
+    update_habit_stats(habit, today, created, was_completed, bool(log.completed))
+    record_habit_day(habit.id, today, log.value, bool(log.completed))
+    if habit.is_shared:
+        refresh_habit_group(habit.shared_id, today)
+    if bool(log.completed) != was_completed:
+        adjust_counter([user.id], 'habit_completions_count', 1 if log.completed else -1)
+        bump_leaderboard_score(user.id, completions_delta=1 if log.completed else -1, day=today)
+    bump_state_version({user.id} | habit_group_members(habit.shared_id))
+    touch_entries(habits=[habit])
+    return {'habits_completed', 'streak'}
+
+def apply_toggle_task(user, data):
+    task = owned_entry(Task, data.get('id'), user)
+    
+    task.completed = not task.completed
+    if task.completed:
+        task.completed_date = date.today()
+    else:
+        task.completed_date = None
         
-        # Create for friends
-        for fid in friend_ids:
-            # Verify friendship exists? Skipped for MVP speed, assuming UI provides valid IDs
-            f_habit = Habit(text=text, user_id=fid, target=target, frequency=frequency, days=days_str, is_shared=True, shared_id=shared_id)
-            db.session.add(f_habit)
-            
-        db.session.commit()
-        check_new_achievements(current_user)
-        return jsonify({'success': True})
+    adjust_counter([user.id], 'tasks_completed_count', 1 if task.completed else -1)
+    if task.is_shared:
+        refresh_task_group(task.shared_id, task.scheduled_date)
+    bump_state_version({user.id} | task_group_members(task.shared_id))
+    touch_entries(tasks=[task])
+    return {'tasks_completed'} if task.completed else set()
+
+def apply_delete_habit(user, data):
+    habit = owned_entry(Habit, data.get('id'), user)
+
+    completions = habit.stats.total_completions if habit.stats else HabitLog.query.filter_by(habit_id=habit.id, completed=True).count()
+    adjust_counter([user.id], 'habits_created_count', -1)
+    adjust_counter([user.id], 'habit_completions_count', -(completions or 0))
+    week_completions = HabitLog.query.filter(HabitLog.habit_id == habit.id, HabitLog.completed == True,
+                                             HabitLog.date >= get_start_of_week(date.today())).count()
+    bump_leaderboard_score(user.id, completions_delta=-week_completions)
+    bump_state_version({user.id} | habit_group_members(habit.shared_id))
+    db.session.delete(habit)
+    refresh_habit_group(habit.shared_id, date.today())
+    touch_entries(habits=[habit])
+    return set()
+
+def apply_delete_task(user, data):
+    task = owned_entry(Task, data.get('id'), user)
+
+    if task.completed:
+        adjust_counter([user.id], 'tasks_completed_count', -1)
+    bump_state_version({user.id} | task_group_members(task.shared_id))
+    db.session.delete(task)
+    refresh_task_group(task.shared_id, task.scheduled_date)
+    touch_entries(tasks=[task])
+    return set()
+
+def finish_mutation(user, conditions):
+    # Settle today's streak in the same transaction, commit, then evaluate achievements once.
+    # Returns the touched habit/task ids and the state version this commit produced.
+    if 'streak' in conditions:
+        check_global_streak(user)
+    # Read inside the transaction: our state_version UPDATE holds the row until the commit,
+    # so a concurrent change cannot slip into the version we report (the query also flushes new ids)
+    version = db.session.query(User.state_version).filter_by(id=user.id).scalar()
+    touched = {kind: {obj.id for obj in objs} for kind, objs in db.session.info.pop('touched', {}).items()}
+    db.session.commit()
+    if conditions:
+        check_new_achievements(user, sorted(conditions))
+    return touched, version
+
+def mutation_response(user, result):
+    # Success answer of the single mutation routes: the changed entries instead of a second /api/state fetch
+    touched, version = result
+    return jsonify({'success': True, 'delta': state_delta(user, touched), 'version': state_etag(user, version)})
+
+@app.route('/api/add_habit', methods=['POST'])
+@login_required
+def add_habit():
+    try:
+        return mutation_response(current_user, finish_mutation(current_user, apply_add_habit(current_user, request.json)))
+    except MutationRejected as e:
+        return rejected_response(e)
     except Exception as e:
         logger.error(f"Add habit error: {e}")
         return jsonify({'success': False})
@@ -487,31 +1570,9 @@ def add_habit():
 @login_required
 def add_task():
     try:
-        data = request.json
-        text = data.get('text')
-        date_offset = int(data.get('offset', 0)) # 0 = today, 1 = tomorrow ...
-        friend_ids = data.get('friends', [])
-        
-        if not text: return jsonify({'success': False})
-        
-        s_date = date.today() + timedelta(days=date_offset)
-        
-        shared_id = None
-        is_shared = len(friend_ids) > 0
-        if is_shared:
-            shared_id = str(uuid.uuid4())
-
-        # Create for self
-        t = Task(text=text, user_id=current_user.id, scheduled_date=s_date, is_shared=is_shared, shared_id=shared_id)
-        db.session.add(t)
-
-        # Create for friends
-        for fid in friend_ids:
-            f_task = Task(text=text, user_id=fid, scheduled_date=s_date, is_shared=True, shared_id=shared_id)
-            db.session.add(f_task)
-
-        db.session.commit()
-        return jsonify({'success': True})
+        return mutation_response(current_user, finish_mutation(current_user, apply_add_task(current_user, request.json)))
+    except MutationRejected as e:
+        return rejected_response(e)
     except Exception as e:
         logger.error(f"Task error: {e}")
         return jsonify({'success': False})
@@ -520,61 +1581,56 @@ def add_task():
 @login_required
 def toggle_habit():
     try:
-        data = request.json
-        habit_id = data.get('id')
-        habit = Habit.query.get(habit_id)
-        if habit.user_id != current_user.id: return jsonify({'success': False})
-        
-        today = date.today()
-        
-        if habit.frequency == 'weekly_flex':
-             # Logic for weekly: Just add a log for today with +1 value
-             log = HabitLog.query.filter_by(habit_id=habit.id, date=today).first()
-             if not log:
-                 log = HabitLog(habit_id=habit.id, date=today, value=0)
-                 db.session.add(log)
-             
-             # Check total for week
-             start_week = get_start_of_week(today)
-             logs_week = HabitLog.query.filter(HabitLog.habit_id==habit.id, HabitLog.date >= start_week).all()
-             total = sum(l.value for l in logs_week)
-             
-             # If strictly toggling:
-             # Complex logic: If we assume UI sends "do it", we increment.
-             # If user spams click, we assume they want to add reps.
-             # But if completed, maybe we don't toggle off for weekly?
-             # Let's keep simple: Increment
-             log.value += 1
-             # Recalc total
-             if (total + 1) >= habit.target:
-                 # Mark all logs this week as completed? Or just conceptual?
-                 pass 
-        else:
-            log = HabitLog.query.filter_by(habit_id=habit.id, date=today).first()
-            if not log:
-                log = HabitLog(habit_id=habit.id, date=today, value=0, completed=False)
-                db.session.add(log)
-            
-            if log.completed:
-                log.completed = False
-                log.value = 0
-            else:
-                log.value += 1
-                if log.value >= habit.target:
-                    log.value = habit.target
-                    log.completed = True
-
-        db.session.commit()
-        check_global_streak(current_user)
-        check_new_achievements(current_user)
-        if habit.is_shared:
-            check_group_streak(habit.shared_id)
-            
-        return jsonify({'success': True})
+        return mutation_response(current_user, finish_mutation(current_user, apply_toggle_habit(current_user, request.json)))
+    except MutationRejected as e:
+        return rejected_response(e)
     except Exception as e:
         logger.error(f"Add habit error: {e}")
         return jsonify({'success': False})
 
+# Operations accepted by /api/batch; each takes the same payload as its single route
+BATCH_OPERATIONS = {
+    'add_habit': apply_add_habit,
+    'add_task': apply_add_task,
+    'toggle_habit': apply_toggle_habit,
+    'increment_habit': lambda user, data: apply_toggle_habit(user, data, reset=False),
+    'toggle_task': apply_toggle_task,
+    'delete_habit': apply_delete_habit,
+    'delete_task': apply_delete_task,
+}
+BATCH_MAX_OPERATIONS = 50
+
+@app.route('/api/batch', methods=['POST'])
+@login_required
+def batch():
+    # Applies an ordered list of operations in one transaction and answers with the new state (like /api/state)
+    ops = (request.get_json(silent=True) or {}).get('ops')
+    if not isinstance(ops, list) or not ops:
+        return jsonify({'success': False, 'message': 'ops must be a non-empty list'}), 400
+    if len(ops) > BATCH_MAX_OPERATIONS:
+        return jsonify({'success': False, 'message': f'At most {BATCH_MAX_OPERATIONS} operations per batch'}), 400
+
+    conditions = set()
+    for index, op in enumerate(ops):
+        apply = BATCH_OPERATIONS.get(op.get('op')) if isinstance(op, dict) else None
+        try:
+            if apply is None: raise MutationRejected('Unknown operation')
+            conditions |= apply(current_user, op)
+        except Exception as e:
+            # All or nothing: nothing of the batch is kept; the answer names the operation that failed
+            db.session.rollback()
+            if not isinstance(e, MutationRejected):
+                logger.error(f"Batch error in operation {index}: {e}")
+                e = MutationRejected('Invalid operation')
+            return jsonify({'success': False, 'failed': index, 'message': e.message}), e.status
+    finish_mutation(current_user, conditions)
+
+    etag, data = cached_user_state(current_user)
+    response = jsonify(data)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/habit/<int:id>')
 @login_required
 def get_habit_details(id):
@@ -582,66 +1638,44 @@ def get_habit_details(id):
     if habit.user_id != current_user.id:
         return jsonify({'error': 'Unauthorized'}), 403
     
-    # Get all logs for this habit sorted by date
-    logs = HabitLog.query.filter_by(habit_id=id).order_by(HabitLog.date.desc()).all()
-    
-    # Calculate Streaks
-    current_streak = 0
-    best_streak = 0
-    temp_streak = 0
-    
     today = date.today()
-    # For calculation, we need ascending order
-    asc_logs = HabitLog.query.filter_by(habit_id=id).order_by(HabitLog.date.asc()).all()
-    
-    # Simple streak calculation (daily/specific)
-    # Note: A real streak calc would check if days were missed.
-    # For MVP: consecutive days with completed=True
-    last_date = None
-    for l in asc_logs:
-        if l.completed:
-            if last_date and (l.date - last_date).days == 1:
-                temp_streak += 1
-            else:
-                temp_streak = 1
-            best_streak = max(best_streak, temp_streak)
-        else:
-            temp_streak = 0
-        last_date = l.date
-        
-    # Current Streak needs to check if it's still active (today or yesterday)
-    active_streak = 0
-    if asc_logs:
-        # Check from end
-        check_date = today
-        idx = len(asc_logs) - 1
-        while idx >= 0:
-            l = asc_logs[idx]
-            if l.completed and (l.date == check_date or l.date == check_date - timedelta(days=1)):
-                active_streak += 1
-                check_date = l.date - timedelta(days=1)
-                idx -= 1
-            else:
-                break
-    
-    current_streak = active_streak
-    total_done = sum(1 for l in logs if l.completed)
+    stats = habit.stats
+    if stats is None:
+        stats = rebuild_habit_stats([habit.id])[habit.id]
+        db.session.commit()
+
+    # Calendar window: ?from=&to= (ISO dates, at most a year), default last 30 days
+    try:
+        window_to = date.fromisoformat(request.args['to']) if request.args.get('to') else today
+        window_from = date.fromisoformat(request.args['from']) if request.args.get('from') else window_to - timedelta(days=29)
+        recent_before = date.fromisoformat(request.args['before']) if request.args.get('before') else None
+    except ValueError:
+        return jsonify({'error': 'Invalid date'}), 400
+    if window_from > window_to or (window_to - window_from).days >= 366:
+        return jsonify({'error': 'Invalid range'}), 400
+    recent_limit = min(max(request.args.get('limit', 5, type=int), 1), 50)
     
-    # History for calendar (last 30 days)
+    # History for calendar (newest first) from the completion bitmaps
+    timeline = load_habit_timeline(id, window_from, window_to)
     history = []
-    for i in range(30):
-        d = today - timedelta(days=i)
-        log = next((l for l in logs if l.date == d), None)
+    for i in range(timeline.days - 1, -1, -1):
+        d = window_from + timedelta(days=i)
+        completed = bool(timeline.completed >> i & 1)
         history.append({
             'date': d.strftime('%Y-%m-%d'),
             'day': d.day,
-            'completed': log.completed if log else False,
-            'partial': (log.value > 0 and not log.completed) if log else False
+            'completed': completed,
+            'partial': timeline.values[i] > 0 and not completed
         })
         
-    # Recent Activity
+    # Recent Activity, paginated by date cursor (?before=<date of last entry>)
+    recent_query = HabitLog.query.filter(HabitLog.habit_id == id)
+    if recent_before:
+        recent_query = recent_query.filter(HabitLog.date < recent_before)
+    recent_logs = recent_query.order_by(HabitLog.date.desc()).limit(recent_limit + 1).all()
+    next_cursor = recent_logs[recent_limit - 1].date.isoformat() if len(recent_logs) > recent_limit else None
     recent = []
-    for l in logs[:5]:
+    for l in recent_logs[:recent_limit]:
         recent.append({
             'date': l.date.strftime('%Y-%m-%d'),
             'display_date': l.date.strftime('%b %d, %A'),
@@ -649,37 +1683,61 @@ def get_habit_details(id):
             'value': l.value
         })
 
+    total_done = stats.total_completions or 0
     return jsonify({
         'id': habit.id,
         'text': habit.text,
         'target': habit.target,
         'frequency': habit.frequency,
-        'current_streak': current_streak,
-        'best_streak': best_streak,
+        'current_streak': active_streak(stats, today),
+        'best_streak': stats.best_streak or 0,
         'total_done': total_done,
-        'completion_rate': round((total_done / len(logs) * 100) if logs else 0),
+        'completion_rate': round((total_done / stats.total_logged_days * 100) if stats.total_logged_days else 0),
         'history': history,
-        'recent': recent
+        'recent': recent,
+        'recent_cursor': next_cursor
+    })
+
+@app.route('/habit/<int:id>/year')
+@login_required
+def get_habit_year(id):
+    # Year heatmap (?year=, default current) and run statistics, computed on the completion bitmaps
+    habit = Habit.query.get_or_404(id)
+    if habit.user_id != current_user.id:
+        return jsonify({'error': 'Unauthorized'}), 403
+    today = date.today()
+    year = request.args.get('year', today.year, type=int)
+    if not 1 <= year <= 9999:
+        return jsonify({'error': 'Invalid year'}), 400
+    start = date(year, 1, 1)
+    end = min(date(year, 12, 31), today)
+    if end < start:
+        return jsonify({'error': 'Invalid year'}), 400
+
+    timeline = load_habit_timeline(habit.id, start, end)
+    last = timeline.days - 1
+    # A run counts as current while it ends today or yesterday (see active_streak)
+    current_run = trailing_run(timeline.completed, last) or (trailing_run(timeline.completed, last - 1) if end == today else 0)
+    return jsonify({
+        'year': year,
+        'start': start.isoformat(),
+        # Per day from Jan 1: 0 = nothing, 1 = partial, 2 = completed
+        'days': [2 if timeline.completed >> i & 1 else (1 if timeline.values[i] else 0) for i in range(timeline.days)],
+        'completed_days': popcount(timeline.completed),
+        'logged_days': popcount(timeline.logged),
+        'longest_run': longest_run(timeline.completed),
+        'current_run': current_run,
+        'weekday_rates': weekday_rates(timeline),
+        'last_30_days': popcount(bits_window(timeline.completed, max(0, last - 29), last)),
     })
 
 @app.route('/api/toggle_task', methods=['POST'])
 @login_required
 def toggle_task():
     try:
-        data = request.json
-        tid = data.get('id')
-        task = Task.query.get(tid)
-        if task.user_id != current_user.id: return jsonify({'success': False})
-        
-        task.completed = not task.completed
-        if task.completed:
-            task.completed_date = date.today()
-            check_new_achievements(current_user) # Check for task completion
-        else:
-            task.completed_date = None
-            
-        db.session.commit()
-        return jsonify({'success': True})
+        return mutation_response(current_user, finish_mutation(current_user, apply_toggle_task(current_user, request.json)))
+    except MutationRejected as e:
+        return rejected_response(e)
     except:
         return jsonify({'success': False})
 
@@ -687,15 +1745,9 @@ def toggle_task():
 @login_required
 def delete_habit():
     try:
-        data = request.json
-        habit_id = data.get('id')
-        habit = Habit.query.get_or_404(habit_id)
-        if habit.user_id != current_user.id:
-            return jsonify({'success': False, 'message': 'Unauthorized'}), 403
-            
-        db.session.delete(habit)
-        db.session.commit()
-        return jsonify({'success': True})
+        return mutation_response(current_user, finish_mutation(current_user, apply_delete_habit(current_user, request.json)))
+    except MutationRejected as e:
+        return rejected_response(e)
     except Exception as e:
         logger.error(f"Delete habit error: {e}")
         return jsonify({'success': False})
@@ -704,37 +1756,64 @@ def delete_habit():
 @login_required
 def delete_task():
     try:
-        data = request.json
-        task_id = data.get('id')
-        task = Task.query.get_or_404(task_id)
-        if task.user_id != current_user.id:
-            return jsonify({'success': False, 'message': 'Unauthorized'}), 403
-            
-        db.session.delete(task)
-        db.session.commit()
-        return jsonify({'success': True})
+        return mutation_response(current_user, finish_mutation(current_user, apply_delete_task(current_user, request.json)))
+    except MutationRejected as e:
+        return rejected_response(e)
     except:
         return jsonify({'success': False})
 
 # --- Friend API ---
 
+def username_search_available():
+    def check():
+        if db.engine.dialect.name == 'sqlite':
+            sql = "SELECT 1 FROM sqlite_master WHERE name = 'user_search'"
+        elif db.engine.dialect.name == 'postgresql':
+            sql = "SELECT 1 FROM pg_indexes WHERE indexname = 'ix_user_username_trgm'"
+        else:
+            return False
+        return db.session.execute(db.text(sql)).first() is not None
+    return cache.get_or_load(('username_search',), check)
+
+def index_username(user):
+    # Usernames never change, so registering is the only write to the search table (call before commit)
+    if db.engine.dialect.name == 'sqlite' and username_search_available():
+        db.session.execute(db.text("INSERT INTO user_search(rowid, username) VALUES (:id, :username)"),
+                           {'id': user.id, 'username': user.username})
+
+def find_users(query, exclude_id, limit=5):
+    # Prefix matches first (index range scan on lower(username)), then substring matches from the
+    # trigram index for queries of 3+ characters
+    query = query.strip().lower()
+    if not query: return []
+    lower = db.func.lower(User.username)
+    users = User.query.filter(lower >= query, lower < query + '\U0010ffff', User.id != exclude_id).order_by(lower).limit(limit).all()
+    if len(users) >= limit or len(query) < 3 or not username_search_available(): return users
+
+    seen = {u.id for u in users} | {exclude_id}
+    wanted = limit - len(users) + len(seen)
+    if db.engine.dialect.name == 'sqlite':
+        phrase = '"' + query.replace('"', '""') + '"'
+        ids = [rid for (rid,) in db.session.execute(db.text(
+            "SELECT rowid FROM user_search WHERE user_search MATCH :q ORDER BY length(username), rowid LIMIT :n"),
+            {'q': phrase, 'n': wanted}).all()]
+        more = {u.id: u for u in User.query.filter(User.id.in_([i for i in ids if i not in seen])).all()}
+        users += [more[i] for i in ids if i in more]
+    else:
+        pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        users += User.query.filter(lower.like(pattern, escape='\\'), User.id.not_in(seen)).order_by(
+            db.func.length(User.username), User.id).limit(limit - len(users)).all()
+    return users[:limit]
+
 @app.route('/api/search_users', methods=['POST'])
 @login_required
 def search_users():
     query = request.json.get('query')
     if not query: return jsonify([])
-    users = User.query.filter(User.username.ilike(f'%{query}%'), User.id != current_user.id).limit(5).all()
-    results = []
-    for u in users:
-        # Check status
-        f1 = Friendship.query.filter_by(sender_id=current_user.id, receiver_id=u.id).first()
-        f2 = Friendship.query.filter_by(sender_id=u.id, receiver_id=current_user.id).first()
-        status = 'msg'
-        if f1: status = f1.status # pending or accepted
-        elif f2: status = f2.status + '_received' if f2.status == 'pending' else 'accepted'
-        
-        results.append({'id': u.id, 'username': u.username, 'status': status})
-    return jsonify(results)
+    users = find_users(query, current_user.id)
+
+    graph = load_friend_graph(current_user) if users else {}
+    return jsonify([{'id': u.id, 'username': u.username, 'status': friend_status(graph.get(u.id))} for u in users])
 
 @app.route('/api/add_friend', methods=['POST'])
 @login_required
@@ -743,6 +1822,7 @@ def add_friend():
     if not Friendship.query.filter_by(sender_id=current_user.id, receiver_id=target_id).first():
         f = Friendship(sender_id=current_user.id, receiver_id=target_id, status='pending')
         db.session.add(f)
+        bump_friends_version([current_user.id, target_id])
         db.session.commit()
     return jsonify({'success': True})
 
@@ -753,6 +1833,7 @@ def accept_friend():
     f = Friendship.query.filter_by(sender_id=target_id, receiver_id=current_user.id).first()
     if f:
         f.status = 'accepted'
+        bump_friends_version([current_user.id, target_id])
         db.session.commit()
     return jsonify({'success': True})
 
@@ -761,10 +1842,12 @@ def accept_friend():
 def remove_friend():
     target_id = request.json.get('id')
     # Check both directions
-    Friendship.query.filter(
+    removed = Friendship.query.filter(
         ((Friendship.sender_id==current_user.id) & (Friendship.receiver_id==target_id)) |
         ((Friendship.sender_id==target_id) & (Friendship.receiver_id==current_user.id))
     ).delete()
+    if removed:
+        bump_friends_version([current_user.id, target_id])
     db.session.commit()
     return jsonify({'success': True})
 
@@ -798,7 +1881,10 @@ def invite_to_habit():
                 shared_id=habit.shared_id
             )
             db.session.add(friend_habit)
+            adjust_counter([friend_id], 'habits_created_count', 1)
             
+        refresh_habit_group(habit.shared_id, date.today())
+        bump_state_version({current_user.id, friend_id} | habit_group_members(habit.shared_id))
         db.session.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -811,27 +1897,17 @@ def get_user_details(id):
     user = User.query.get_or_404(id)
     
     # Check friendship status
-    status = 'none'
     if user.id != current_user.id:
-        f1 = Friendship.query.filter_by(sender_id=current_user.id, receiver_id=user.id).first()
-        f2 = Friendship.query.filter_by(sender_id=user.id, receiver_id=current_user.id).first()
-        if f1: status = f1.status
-        elif f2: status = f2.status + '_received' if f2.status == 'pending' else 'accepted'
+        edge = load_friend_graph(current_user).get(user.id)
+        status = friend_status(edge) if edge else 'none'
     else:
         status = 'self'
 
-    # Get achievements
-    user_achvs = UserAchievement.query.filter_by(user_id=user.id).order_by(UserAchievement.date_earned.desc()).limit(5).all()
-    achievements = []
-    earned_ids = {ua.achievement_id for ua in user_achvs}
-    
-    for ua in user_achvs:
-        ach = Achievement.query.get(ua.achievement_id)
-        achievements.append({
-            'title': ach.title,
-            'icon': ach.icon,
-            'earned': True
-        })
+    # Latest achievements
+    recent = db.session.query(Achievement.title, Achievement.icon).join(
+        UserAchievement, UserAchievement.achievement_id == Achievement.id
+    ).filter(UserAchievement.user_id == user.id).order_by(UserAchievement.date_earned.desc()).limit(5).all()
+    achievements = [{'title': title, 'icon': icon, 'earned': True} for title, icon in recent]
         
     achievement_count = UserAchievement.query.filter_by(user_id=user.id).count()
 
@@ -848,28 +1924,57 @@ def get_user_details(id):
 @app.route('/api/get_friends')
 @login_required
 def get_friends():
-    # Complex query to get all accepted friends
-    fs = Friendship.query.filter(
-        ((Friendship.sender_id==current_user.id) | (Friendship.receiver_id==current_user.id)) & 
-        (Friendship.status=='accepted')
-    ).all()
-    
-    friends = []
-    for f in fs:
-        uid = f.receiver_id if f.sender_id == current_user.id else f.sender_id
-        u = User.query.get(uid)
-        friends.append({'id': u.id, 'username': u.username, 'streak': u.current_streak})
-    return jsonify(friends)
+    friends = [e for e in load_friend_graph(current_user).values() if 'accepted' in (e.sent, e.received)]
+    # Streaks change daily, so they are read fresh rather than cached with the graph
+    streaks = dict(db.session.query(User.id, User.current_streak).filter(
+        User.id.in_([e.id for e in friends])).all()) if friends else {}
+    return jsonify([{'id': e.id, 'username': e.username, 'streak': streaks.get(e.id)} for e in friends])
+
+# Ranking keys of /api/leaderboard: the chosen one first, the others break ties
+LEADERBOARD_ORDER = {
+    'streak': ('streak', 'week', 'achievements'),
+    'week': ('week', 'streak', 'achievements'),
+    'achievements': ('achievements', 'streak', 'week'),
+}
+
+@app.route('/api/leaderboard')
+@login_required
+def leaderboard():
+    # ?by=streak|week|achievements&limit=N: top N of the user and their friends plus the user's own rank,
+    # read from User and LeaderboardScore by primary key in one query
+    by = request.args.get('by', 'streak')
+    if by not in LEADERBOARD_ORDER:
+        return jsonify({'error': 'Invalid order'}), 400
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    ids = [current_user.id] + [e.id for e in load_friend_graph(current_user).values() if 'accepted' in (e.sent, e.received)]
+
+    week_start = get_start_of_week(date.today())
+    scores = {
+        'streak': db.func.coalesce(User.current_streak, 0),
+        'week': db.case((LeaderboardScore.week_start == week_start, LeaderboardScore.week_completions), else_=0),
+        'achievements': db.func.coalesce(LeaderboardScore.achievement_count, 0),
+    }
+    rank = db.func.rank().over(order_by=[scores[key].desc() for key in LEADERBOARD_ORDER[by]])
+    ranked = db.select(User.id, User.username, rank.label('rank'), *(v.label(k) for k, v in scores.items())).outerjoin(
+        LeaderboardScore, LeaderboardScore.user_id == User.id
+    ).where(User.id.in_(ids)).subquery()
+    rows = db.session.execute(db.select(ranked).where((ranked.c.rank <= limit) | (ranked.c.id == current_user.id))
+                              .order_by(ranked.c.rank, ranked.c.username)).all()
+
+    entries = [{'rank': r.rank, 'id': r.id, 'username': r.username, 'streak': r.streak, 'week': r.week,
+                'achievements': r.achievements} for r in rows]
+    return jsonify({
+        'by': by,
+        'week_start': week_start.isoformat(),
+        'entries': [e for e in entries if e['rank'] <= limit][:limit],
+        'me': next((e for e in entries if e['id'] == current_user.id), None),
+    })
 
 @app.route('/api/get_pending_requests')
 @login_required
 def get_pending():
-    fs = Friendship.query.filter_by(receiver_id=current_user.id, status='pending').all()
-    reqs = []
-    for f in fs:
-        u = User.query.get(f.sender_id)
-        reqs.append({'id': u.id, 'username': u.username})
-    return jsonify(reqs)
+    graph = load_friend_graph(current_user)
+    return jsonify([{'id': e.id, 'username': e.username} for e in graph.values() if e.received == 'pending'])
 
 # --- FOCUS MODULE API ---
 
@@ -895,7 +2000,7 @@ def api_login():
 @app.route('/api/sync_usage', methods=['POST'])
 def sync_usage():
     try:
-        data = request.json
+        data = read_json_body()
         usage_list = []
         user_id = None
         
@@ -921,37 +2026,82 @@ def sync_usage():
         if not user_id:
              # Strict Mode: Fail if we don't know who this is
              return jsonify({"status": "error", "message": "Authentication required or user_id missing"}), 401
+
+        user = db.session.get(User, int(user_id))
+        if not user:
+             return jsonify({"status": "error", "message": "User not found"}), 404
+
+        # Delta protocol: the client echoes the cursor of its last accepted sync (body or If-Match)
+        # and then only uploads rows changed since. A stale cursor means the server may be missing
+        # deltas (other device, restored backup), so we ask for one full upload.
+        sent_cursor = data.get('cursor') if isinstance(data, dict) else None
+        if sent_cursor is None and request.if_match:
+            sent_cursor = next(iter(request.if_match), None)
+        current_cursor = user.usage_cursor or 0
+        resync = sent_cursor is None or str(sent_cursor) != str(current_cursor)
              
-        for item in usage_list:
+        # Normalize once; later items for the same package/day win
+        rows = {}
+        results = []
+        for i, item in enumerate(usage_list):
+            if not isinstance(item, dict):
+                results.append({'index': i, 'status': 'skipped', 'reason': 'invalid item'})
+                continue
             # Support multiple key names from different app versions
             pkg = item.get('packageName') or item.get('package')
             minutes = item.get('usageDuration')
             if minutes is None: minutes = item.get('minutes')
             if minutes is None: minutes = item.get('time')
             if minutes is None: minutes = 0
-            minutes = int(minutes)
             
-            # Use string date directly
-            d_str = item.get('date')
-            if not d_str:
-                d_str = date.today().isoformat()
+            d = parse_usage_date(item['date']) if item.get('date') else date.today()
             
-            if not pkg: continue
-
-            # Check if exists
-            entry = AppUsage.query.filter_by(user_id=user_id, package_name=pkg, date=d_str).first()
-            if entry:
-                entry.usage_minutes = minutes 
-            else:
-                entry = AppUsage(user_id=user_id, package_name=pkg, usage_minutes=minutes, date=d_str)
-                db.session.add(entry)
+            if not pkg:
+                results.append({'index': i, 'status': 'skipped', 'reason': 'missing package'})
+                continue
+            if not d:
+                results.append({'index': i, 'status': 'skipped', 'reason': 'invalid date'})
+                continue
+            try:
+                minutes = int(minutes)
+            except (TypeError, ValueError):
+                results.append({'index': i, 'status': 'skipped', 'reason': 'invalid minutes'})
+                continue
+
+            rows[(pkg, d)] = {'user_id': int(user_id), 'package_name': pkg, 'date': d, 'usage_minutes': minutes}
+            results.append({'index': i, 'status': 'ok', 'package': pkg, 'date': d.isoformat()})
         
-        db.session.commit()
-        return jsonify({"status": "success"})
+        if rows:
+            upsert_app_usage(list(rows.values()))
+            user.usage_cursor = current_cursor + 1
+            db.session.commit()
+
+        response = jsonify({"status": "success", "written": len(rows), "results": results,
+                            "cursor": str(user.usage_cursor or 0), "resync": resync})
+        response.set_etag(str(user.usage_cursor or 0))
+        return response
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Sync error: {e}")
         return jsonify({"status": "error"})
 
+def read_json_body(max_size=10 * 1024 * 1024):
+    # Focus clients may gzip large uploads (Content-Encoding: gzip)
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        raw = inflater.decompress(request.get_data(), max_size)
+        if inflater.unconsumed_tail:
+            raise ValueError("Decompressed payload too large")
+        return json.loads(raw)
+    return request.get_json(force=True)
+
+def upsert_app_usage(rows):
+    # One batched INSERT ... ON CONFLICT DO UPDATE, keyed by uq_app_usage_user_package_date
+    upsert(AppUsage, rows, ['user_id', 'package_name', 'date'],
+           lambda table, new: {'usage_minutes': new.usage_minutes},
+           # Re-sent but unchanged rows cost no write
+           where=lambda table, new: table.c.usage_minutes != new.usage_minutes)
+
 @app.route('/api/get_config', methods=['GET'])
 @app.route('/api/get_config/<int:route_user_id>', methods=['GET'])
 def get_config(route_user_id=None):
@@ -973,10 +2123,18 @@ def get_config(route_user_id=None):
         if not user:
              return jsonify({"status": "error", "message": "User not found"}), 404
         
-        limits = AppLimit.query.filter_by(user_id=user.id).all()
-        limit_data = [{"packageName": l.package_name, "limit": l.limit_minutes} for l in limits]
+        # Limits are versioned per user: answer unchanged configs without reading AppLimit
+        version = str(user.limits_version or 0)
+        if request.if_none_match.contains(version):
+            return '', 304, {'ETag': f'"{version}"'}
+        if request.args.get('version') == version:
+            return jsonify({"limits": [], "unchanged": True, "version": version, "status": "success"})
+
+        limit_data = [{"packageName": l.package_name, "limit": l.limit_minutes} for l in load_app_limits(user)]
         
-        return jsonify({"limits": limit_data, "status": "success"})
+        response = jsonify({"limits": limit_data, "version": version, "status": "success"})
+        response.set_etag(version)
+        return response
     except Exception as e:
         logger.error(f"Config error: {e}")
         return jsonify({"status": "error"})
@@ -1000,7 +2158,9 @@ def add_app_limit():
         new_limit = AppLimit(user_id=current_user.id, package_name=pkg, limit_minutes=limit)
         db.session.add(new_limit)
     
+    current_user.limits_version = (current_user.limits_version or 0) + 1
     db.session.commit()
+    cache.invalidate(('app_limits', current_user.id))
     flash(f"Limit für {pkg} gespeichert.")
     return redirect(url_for('focus_dashboard'))
 
@@ -1009,19 +2169,29 @@ def add_app_limit():
 def delete_app_limit():
     pkg = request.form.get('package')
     AppLimit.query.filter_by(user_id=current_user.id, package_name=pkg).delete()
+    current_user.limits_version = (current_user.limits_version or 0) + 1
     db.session.commit()
+    cache.invalidate(('app_limits', current_user.id))
     flash("Limit gelöscht.")
     return redirect(url_for('focus_dashboard'))
 
 @app.context_processor
 def inject_focus_data():
+    # Only the focus dashboard shows these; other pages never run the queries
     if not current_user.is_authenticated: return {}
-    today_str = date.today().isoformat()
+    focus = lazy_context('focus_data', load_focus_data)
+    return {
+        'focus_apps': LocalProxy(lambda: focus['focus_apps']),
+        'focus_limits': LocalProxy(lambda: focus['focus_limits']),
+        'focus_total': LocalProxy(lambda: focus['focus_total']),
+    }
+
+def load_focus_data():
     # Get top apps used today
-    usages = AppUsage.query.filter_by(user_id=current_user.id, date=today_str).order_by(AppUsage.usage_minutes.desc()).all()
+    usages = AppUsage.query.filter_by(user_id=current_user.id, date=date.today()).order_by(AppUsage.usage_minutes.desc()).all()
     
     # Get limits
-    limits_raw = AppLimit.query.filter_by(user_id=current_user.id).all()
+    limits_raw = load_app_limits(current_user)
     limits_map = {l.package_name: l.limit_minutes for l in limits_raw}
     
     combined = []
@@ -1040,7 +2210,8 @@ def inject_focus_data():
 # --- Logic ---
 
 def check_global_streak(user):
-    # Simplified Logic for Global Streak (All Daily Habits)
+    # Request path (call before commit): count today as soon as all daily habits are done (constant number of queries).
+    # Misses and group completions that happen later are settled by run_streak_rollover.
     today = date.today()
     if user.last_completed_date == today: return
 
@@ -1048,46 +2219,101 @@ def check_global_streak(user):
     habits = Habit.query.filter_by(user_id=user.id, frequency='daily').all()
     if not habits: return # specific logic: if no habits, no streak? or free streak? let's say no streak increment
 
-    all_done = True
+    done_ids = {hid for (hid,) in db.session.query(HabitLog.habit_id).filter(
+        HabitLog.habit_id.in_([h.id for h in habits]), HabitLog.date == today, HabitLog.completed == True).all()}
+    # If shared, the GLOBAL group must be done too
+    groups = read_habit_group_progress({h.shared_id for h in habits if h.is_shared and h.shared_id}, today)
     for h in habits:
-        # Check if individual habit is completed
-        log = HabitLog.query.filter_by(habit_id=h.id, date=today).first()
-        is_habit_done = (log and log.completed)
-        
-        # If shared, check if GLOBAL group is done
+        if h.id not in done_ids: return
         if h.is_shared:
-            group_members_habits = Habit.query.filter_by(shared_id=h.shared_id).all()
-            for mh in group_members_habits:
-                m_log = HabitLog.query.filter_by(habit_id=mh.id, date=today).first()
-                if not (m_log and m_log.completed):
-                    is_habit_done = False
-                    break
-        
-        if not is_habit_done:
-            all_done = False
-            break
-    
-    if all_done:
-        if user.last_completed_date:
-            delta = (today - user.last_completed_date).days
-            if delta == 1:
-                user.current_streak += 1
-            elif delta > 1:
-                user.current_streak = 1
-        else:
-             user.current_streak = 1
-        user.last_completed_date = today
-        db.session.commit()
+            members_done, total_members = groups.get(h.shared_id, (0, 0))
+            if members_done < total_members: return
 
-def check_group_streak(shared_id):
-    # Check if ALL members completed for today?
-    # This is complex because "today" might not be over.
-    # Usually group streaks are calculated at midnight.
-    # But user wants "reset if one fails".
-    # We can check "Yesterday" to be safe.
-    # For MVP: We just store it. Real logic would require a Cron job or check on access.
-    # For MVP: We just store it. Real logic would require a Cron job or check on access.
-    pass
+    if user.last_completed_date and (today - user.last_completed_date).days == 1:
+        user.current_streak = (user.current_streak or 0) + 1
+    else:
+        user.current_streak = 1
+    user.last_completed_date = today
+    bump_state_version([user.id])
+
+def rollover_streaks(day):
+    # Set-based streak settlement for one finished day; safe to run more than once for the same day
+    scheduled = db.or_(Habit.frequency == 'daily',
+                       db.and_(Habit.frequency == 'specific', Habit.days.like(f"%{day.weekday()}%")))
+    done = db.case((HabitLog.completed == True, 1), else_=0)
+    members = db.select(Habit.id, Habit.user_id, Habit.shared_id, Habit.frequency, done.label('done')).outerjoin(
+        HabitLog, (HabitLog.habit_id == Habit.id) & (HabitLog.date == day)).where(scheduled).subquery()
+
+    # A shared habit counts as done only if every member completed it
+    groups = db.select(members.c.shared_id, db.func.min(members.c.done).label('all_done')).where(
+        members.c.shared_id.is_not(None)).group_by(members.c.shared_id).subquery()
+    effective = db.case((members.c.shared_id.is_not(None), db.func.coalesce(groups.c.all_done, 0)), else_=members.c.done)
+    done_users = db.select(members.c.user_id).select_from(
+        members.outerjoin(groups, groups.c.shared_id == members.c.shared_id)
+    ).where(members.c.frequency == 'daily').group_by(members.c.user_id).having(db.func.min(effective) == 1)
+
+    bumped = {User.state_version: db.func.coalesce(User.state_version, 0) + 1}
+    # Completed users the request path did not count yet (e.g. a friend finished the group later)
+    db.session.execute(db.update(User).where(User.id.in_(done_users), User.last_completed_date == day - timedelta(days=1)).values(
+        {User.current_streak: db.func.coalesce(User.current_streak, 0) + 1, User.last_completed_date: day, **bumped}))
+    db.session.execute(db.update(User).where(User.id.in_(done_users), db.or_(User.last_completed_date.is_(None), User.last_completed_date < day - timedelta(days=1))).values(
+        {User.current_streak: 1, User.last_completed_date: day, **bumped}))
+    # Everyone else missed the day (also undoes a streak counted before a habit was unchecked)
+    db.session.execute(db.update(User).where(User.id.not_in(done_users), User.current_streak != 0,
+                                             db.or_(User.last_completed_date.is_(None), User.last_completed_date <= day)).values(
+        {User.current_streak: 0, **bumped}))
+
+    # Group streaks, guarded by shared_streak_date so each day is applied once
+    done_groups = db.select(groups.c.shared_id).where(groups.c.all_done == 1)
+    db.session.execute(db.update(Habit).where(
+        Habit.shared_id.is_not(None), scheduled,
+        db.or_(Habit.shared_streak_date.is_(None), Habit.shared_streak_date < day)
+    ).values({
+        Habit.shared_streak: db.case((Habit.shared_id.in_(done_groups), db.func.coalesce(Habit.shared_streak, 0) + 1), else_=0),
+        Habit.shared_streak_date: day,
+    }).execution_options(synchronize_session=False))
+
+def run_streak_rollover(until=None):
+    # Settles every finished day since the last recorded rollover (resumable: one transaction per day)
+    until = until or date.today() - timedelta(days=1)
+    last = db.session.query(db.func.max(StreakRollover.day)).scalar()
+    day = last + timedelta(days=1) if last else until
+    processed = []
+    while day <= until:
+        try:
+            rollover_streaks(day)
+            db.session.add(StreakRollover(day=day))
+            db.session.commit()
+            processed.append(day)
+        except exc.IntegrityError:
+            # Another worker finished this day first
+            db.session.rollback()
+        day += timedelta(days=1)
+    return processed
+
+_rollover_checked_day = None
+_rollover_lock = threading.Lock()
+
+@app.before_request
+def schedule_streak_rollover():
+    # In-process scheduler: the first request of a new day settles yesterday in a background thread
+    global _rollover_checked_day
+    today = date.today()
+    if _rollover_checked_day == today: return
+    with _rollover_lock:
+        if _rollover_checked_day == today: return
+        _rollover_checked_day = today
+
+    def run():
+        with app.app_context():
+            try:
+                processed = run_streak_rollover()
+                if processed: logger.info(f"Streak rollover done for {', '.join(d.isoformat() for d in processed)}")
+                prune_idempotency_keys()
+                logger.info(f"Cache (pid {os.getpid()}): {cache.stats()}")
+            except Exception as e:
+                logger.error(f"Streak rollover error: {e}")
+    threading.Thread(target=run, daemon=True).start()
 
 def init_achievements():
     defaults = [
@@ -1111,67 +2337,350 @@ def init_achievements():
                 threshold=d['threshold']
             ))
     db.session.commit()
-
-def check_new_achievements(user):
-    # Retrieve current stats
-    # 1. Habits Created
-    habits_created = Habit.query.filter_by(user_id=user.id).count()
-    
-    # 2. Habits Completed (Total Logs)
-    # Join Logic: HabitLog -> Habit (filter user_id)
-    # habits_completed = HabitLog.query.join(Habit).filter(Habit.user_id == user.id, HabitLog.completed == True).count()
-    # Simplified without explicit Join if backrefs work, or explicit join:
-    habits_completed = db.session.query(HabitLog).join(Habit).filter(Habit.user_id == user.id, HabitLog.completed == True).count()
-    
-    # 3. Tasks Completed
-    tasks_completed = Task.query.filter_by(user_id=user.id, completed=True).count()
-    
-    # 4. Current Streak
-    streak = user.current_streak
-    
-    # Check all achievements
-    all_achvs = Achievement.query.all()
-    user_achvs = {ua.achievement_id for ua in UserAchievement.query.filter_by(user_id=user.id).all()}
-    
-    for ach in all_achvs:
-        if ach.id in user_achvs:
-            continue
-            
-        earned = False
-        if ach.condition_type == 'habits_created' and habits_created >= ach.threshold: earned = True
-        elif ach.condition_type == 'habits_completed' and habits_completed >= ach.threshold: earned = True
-        elif ach.condition_type == 'tasks_completed' and tasks_completed >= ach.threshold: earned = True
-        elif ach.condition_type == 'streak' and streak >= ach.threshold: earned = True
-        
-        if earned:
-            db.session.add(UserAchievement(user_id=user.id, achievement_id=ach.id))
-            db.session.commit()
-            # Optional: Add flash message if triggered by user action
-            # flash(f'🏆 Erfolg freigeschaltet: {ach.title}!')
+    cache.invalidate(('achievement_catalog',))
+
+# Achievement condition_type -> User counter column it is evaluated against
+ACHIEVEMENT_COUNTERS = {
+    'habits_created': 'habits_created_count',
+    'habits_completed': 'habit_completions_count',
+    'tasks_completed': 'tasks_completed_count',
+    'streak': 'current_streak',
+}
+
+def achievement_catalog():
+    # {condition_type: [(threshold, achievement_id), ...] sorted by threshold}; the catalog only
+    # changes in init_achievements, so it is cached until that invalidates it
+    return cache.get_or_load(('achievement_catalog',), load_achievement_catalog, ttl=0)
+
+def load_achievement_catalog():
+    catalog = {}
+    for ach_id, condition, threshold in db.session.query(Achievement.id, Achievement.condition_type, Achievement.threshold).all():
+        catalog.setdefault(condition, []).append((threshold, ach_id))
+    for entries in catalog.values():
+        entries.sort()
+    return catalog
+
+def adjust_counter(user_ids, column, delta):
+    # Atomic counter update (call before commit); user_ids may repeat to count several rows
+    counts = {}
+    for uid in user_ids:
+        if uid: counts[int(uid)] = counts.get(int(uid), 0) + delta
+    col = getattr(User, column)
+    for uid, d in counts.items():
+        if d:
+            User.query.filter(User.id == uid).update({col: db.func.coalesce(col, 0) + d}, synchronize_session=False)
+
+def check_new_achievements(user, condition_types=None):
+    # Evaluates only the given condition types (default: all) against the user's counters
+    catalog = achievement_catalog()
+    candidates = []
+    for condition in (condition_types or catalog.keys()):
+        value = getattr(user, ACHIEVEMENT_COUNTERS.get(condition, ''), None) or 0
+        for threshold, ach_id in catalog.get(condition, []):
+            if threshold > value: break
+            candidates.append(ach_id)
+    if not candidates: return
+
+    earned = {aid for (aid,) in db.session.query(UserAchievement.achievement_id).filter(
+        UserAchievement.user_id == user.id, UserAchievement.achievement_id.in_(candidates)).all()}
+    new = [aid for aid in candidates if aid not in earned]
+    if new:
+        db.session.add_all([UserAchievement(user_id=user.id, achievement_id=aid) for aid in new])
+        bump_leaderboard_score(user.id, achievements_delta=len(new))
+        db.session.commit()
+        # Optional: Add flash message if triggered by user action
+        # flash(f'🏆 Erfolg freigeschaltet: {ach.title}!')
+
+def rebuild_user_counters():
+    # Recomputes the achievement counters from raw rows in one set-based UPDATE
+    habits = db.select(db.func.count(Habit.id)).where(Habit.user_id == User.id).scalar_subquery()
+    completions = db.select(db.func.count(HabitLog.id)).join(Habit, Habit.id == HabitLog.habit_id).where(
+        Habit.user_id == User.id, HabitLog.completed == True).scalar_subquery()
+    tasks = db.select(db.func.count(Task.id)).where(Task.user_id == User.id, Task.completed == True).scalar_subquery()
+    db.session.execute(db.update(User).values(
+        habits_created_count=habits, habit_completions_count=completions, tasks_completed_count=tasks))
+
+def bump_leaderboard_score(user_id, completions_delta=0, achievements_delta=0, day=None):
+    # Incremental LeaderboardScore update (call before commit); completions count toward the week of `day`.
+    # A row still holding an earlier week starts the new week from this delta.
+    if not completions_delta and not achievements_delta: return
+    week_start = get_start_of_week(day or date.today())
+
+    def update(table, new):
+        week_total = db.case((table.c.week_start == new.week_start, table.c.week_completions + completions_delta),
+                             else_=completions_delta)
+        return {'week_start': new.week_start,
+                'week_completions': db.case((week_total > 0, week_total), else_=0),
+                'achievement_count': table.c.achievement_count + achievements_delta}
+
+    upsert(LeaderboardScore, [{'user_id': user_id, 'week_start': week_start, 'week_completions': max(completions_delta, 0),
+                               'achievement_count': max(achievements_delta, 0)}], ['user_id'], update)
+
+def rebuild_leaderboard_scores():
+    # Recompute all LeaderboardScore rows for the current week in one INSERT ... SELECT
+    week_start = get_start_of_week(date.today())
+    week = db.select(db.func.count(HabitLog.id)).join(Habit, Habit.id == HabitLog.habit_id).where(
+        Habit.user_id == User.id, HabitLog.completed == True, HabitLog.date >= week_start).scalar_subquery()
+    achievements = db.select(db.func.count(UserAchievement.id)).where(UserAchievement.user_id == User.id).scalar_subquery()
+    LeaderboardScore.query.delete()
+    db.session.execute(db.insert(LeaderboardScore).from_select(
+        ['user_id', 'week_start', 'week_completions', 'achievement_count'],
+        db.select(User.id, db.literal(week_start, db.Date), week, achievements)))
+
+# --- Schema Migrations ---
+# Each migration runs once, in order, and is recorded in schema_version.
+# Add new ones at the end with the next version number; never renumber.
+MIGRATIONS = []
+
+def migration(version):
+    def register(fn):
+        MIGRATIONS.append((version, fn.__name__, fn))
+        return fn
+    return register
+
+def add_missing_columns(table, columns):
+    existing = {c['name'] for c in db.inspect(db.engine).get_columns(table)}
+    quoted = db.engine.dialect.identifier_preparer.quote(table)
+    for name, ddl in columns:
+        if name not in existing:
+            db.session.execute(db.text(f"ALTER TABLE {quoted} ADD COLUMN {name} {ddl}"))
+
+def create_index_online(index):
+    # CONCURRENTLY keeps Postgres tables writable while the index builds; SQLite has no equivalent
+    sql = str(CreateIndex(index, if_not_exists=True).compile(dialect=db.engine.dialect))
+    if db.engine.dialect.name == 'postgresql':
+        sql = sql.replace("INDEX IF NOT EXISTS", "INDEX CONCURRENTLY IF NOT EXISTS", 1)
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as con:
+            con.execute(db.text(sql))
+    else:
+        db.session.execute(db.text(sql))
+
+def dedupe_rows(model, columns, chunk_size=1000):
+    # Delete duplicate keys in chunks of the leading (integer) key column, keeping the oldest row
+    # (what the old .first() lookups returned). Commits per chunk, so it is safe to resume.
+    lead = columns[0]
+    max_key = db.session.query(db.func.max(lead)).scalar() or 0
+    removed = 0
+    for lo in range(0, max_key + 1, chunk_size):
+        in_chunk = lead.between(lo, lo + chunk_size - 1)
+        keep = db.session.query(db.func.min(model.id)).filter(in_chunk).group_by(*columns)
+        removed += model.query.filter(in_chunk, model.id.not_in(keep)).delete(synchronize_session=False)
+        db.session.commit()
+    if removed: logger.info(f"Removed {removed} duplicate rows from {model.__tablename__}")
+
+def parse_usage_date(value):
+    # Focus clients send ISO dates, sometimes with a time part or without zero padding
+    if isinstance(value, date): return value
+    value = str(value).strip()
+    for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(value[:10], fmt).date()
+        except ValueError:
+            pass
+    return None
+
+@migration(1)
+def legacy_columns():
+    # Replaces the ALTER TABLE loop that used to run (and fail silently) on every start
+    add_missing_columns('task', [
+        ('scheduled_date', 'DATE'),
+        ('is_shared', 'BOOLEAN DEFAULT FALSE'),
+        ('shared_id', 'VARCHAR(36)'),
+    ])
+    add_missing_columns('user', [
+        ('screen_time_limit', 'INTEGER DEFAULT 120'),
+        ('state_version', 'INTEGER DEFAULT 0'),
+    ])
+
+@migration(2)
+def app_usage_date_type(chunk_size=5000):
+    # AppUsage.date was a free-form string; normalize to ISO dates in chunks, then change the type
+    last_id, fixed, dropped = 0, 0, 0
+    while True:
+        rows = db.session.execute(db.text(
+            "SELECT id, user_id, package_name, date FROM app_usage WHERE id > :last ORDER BY id LIMIT :n"
+        ), {'last': last_id, 'n': chunk_size}).all()
+        if not rows: break
+        for row_id, user_id, pkg, raw in rows:
+            parsed = parse_usage_date(raw) if raw is not None else None
+            if parsed is not None and raw == parsed.isoformat(): continue
+            clash = parsed is not None and db.session.execute(db.text(
+                "SELECT 1 FROM app_usage WHERE user_id = :u AND package_name = :p AND date = :d AND id != :id"
+            ), {'u': user_id, 'p': pkg, 'd': parsed.isoformat(), 'id': row_id}).first()
+            if parsed is None or clash:
+                db.session.execute(db.text("DELETE FROM app_usage WHERE id = :id"), {'id': row_id})
+                dropped += 1
+            else:
+                db.session.execute(db.text("UPDATE app_usage SET date = :d WHERE id = :id"), {'d': parsed.isoformat(), 'id': row_id})
+                fixed += 1
+        last_id = rows[-1][0]
+        db.session.commit()
+    logger.info(f"app_usage dates: {fixed} normalized, {dropped} unparseable or duplicate rows dropped")
+
+    # SQLite stores DATE as ISO text already; only real date types need the ALTER
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(db.text("ALTER TABLE app_usage ALTER COLUMN date TYPE DATE USING date::date"))
+
+@migration(3)
+def dedupe_unique_keys():
+    # Older versions allowed duplicate rows for keys that are now unique
+    for model in [HabitLog, Friendship, UserAchievement, ScreenTimeLog, AppUsage, AppLimit]:
+        for index in model.__table__.indexes:
+            if index.unique:
+                dedupe_rows(model, [getattr(model, c.name) for c in index.columns])
+
+@migration(4)
+def hot_lookup_indexes():
+    for table in db.metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda ix: ix.name):
+            create_index_online(index)
+
+@migration(5)
+def focus_sync_versions():
+    add_missing_columns('user', [
+        ('limits_version', 'INTEGER DEFAULT 0'),
+        ('usage_cursor', 'INTEGER DEFAULT 0'),
+    ])
+
+@migration(6)
+def backfill_habit_stats():
+    rebuild_habit_stats()
+
+@migration(7)
+def achievement_counters():
+    add_missing_columns('user', [
+        ('habits_created_count', 'INTEGER DEFAULT 0'),
+        ('habit_completions_count', 'INTEGER DEFAULT 0'),
+        ('tasks_completed_count', 'INTEGER DEFAULT 0'),
+    ])
+    rebuild_user_counters()
+
+@migration(8)
+def shared_streak_date():
+    add_missing_columns('habit', [('shared_streak_date', 'DATE')])
+
+@migration(9)
+def backfill_group_progress():
+    check_group_progress(repair=True)
+
+@migration(10)
+def backfill_screen_time_rollups():
+    rebuild_screen_time_rollups()
+
+@migration(11)
+def username_search():
+    create_index_online(user_username_lower_index)
+    if create_username_search(db.session.connection()) and db.engine.dialect.name == 'sqlite':
+        db.session.execute(db.text("DELETE FROM user_search"))
+        db.session.execute(db.text('INSERT INTO user_search(rowid, username) SELECT id, username FROM "user"'))
+    cache.invalidate(('username_search',))
+
+@migration(12)
+def friends_version():
+    add_missing_columns('user', [('friends_version', 'INTEGER DEFAULT 0')])
+
+@migration(13)
+def backfill_leaderboard_scores():
+    rebuild_leaderboard_scores()
+
+@migration(14)
+def backfill_habit_years():
+    rebuild_habit_years()
+
+def run_migrations():
+    # Fresh databases are created at the latest schema; existing ones get pending migrations only
+    fresh = not db.inspect(db.engine).has_table('user')
+    db.create_all()
+    applied = {v for (v,) in db.session.query(SchemaVersion.version).all()}
+
+    pending = [m for m in sorted(MIGRATIONS) if m[0] not in applied]
+    for version, name, fn in pending:
+        if not fresh:
+            logger.info(f"Applying migration {version}: {name}")
+            try:
+                fn()
+            except Exception:
+                db.session.rollback()
+                raise
+        db.session.add(SchemaVersion(version=version, name=name))
+        db.session.commit()
+    return [name for _, name, _ in pending] if not fresh else []
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute HabitStats, completion bitmaps, achievement counters, leaderboard scores and screen-time rollups from raw rows."""
+    count = len(rebuild_habit_stats())
+    rebuild_user_counters()
+    periods = rebuild_screen_time_rollups()
+    rebuild_leaderboard_scores()
+    years = rebuild_habit_years()
+    db.session.commit()
+    print(f"Rebuilt statistics for {count} habits ({years} completion bitmaps), achievement counters, leaderboard "
+          f"and {periods} screen-time rollups.")
+
+@app.cli.command('streak-rollover')
+def streak_rollover_command():
+    """Settle global and group streaks for all finished days (for cron)."""
+    processed = run_streak_rollover()
+    print(f"Rolled over: {', '.join(d.isoformat() for d in processed)}" if processed else "Streaks are up to date.")
+
+@app.cli.command('check-group-progress')
+@click.option('--repair', is_flag=True, help='Rewrite the differing aggregates from the raw logs.')
+def check_group_progress_command(repair):
+    """Compare SharedGroupProgress with the raw habit logs and tasks."""
+    mismatches = check_group_progress(repair=repair)
+    for (shared_id, day), stored, expected in mismatches:
+        print(f"{shared_id} {day}: stored {stored}, expected {expected}")
+    if repair: db.session.commit()
+    print(f"{len(mismatches)} mismatches" + (" repaired." if repair else "."))
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending database migrations."""
+    applied = run_migrations()
+    print(f"Applied: {', '.join(applied)}" if applied else "Database schema is up to date.")
 
 @app.route('/manifest.json')
 def manifest():
     return send_from_directory('static', 'manifest.json')
 @app.route('/sw.js')
 def service_worker():
-    return send_from_directory('static', 'sw.js')
-
-if __name__ == '__main__':
+    # The precache manifest is part of the script, so every asset change installs a new service worker
+    with open(os.path.join(app.static_folder, 'sw.js')) as f:
+        script = f.read()
+    body = f"self.__PRECACHE_MANIFEST = {json.dumps(precache_manifest())};\n" + script
+    return body, 200, {'Content-Type': 'application/javascript', 'Cache-Control': 'no-cache'}
+
+def precache_manifest():
+    # {revision, assets: [{url, revision}]} for every file in static/, revisions are content hashes
+    def build():
+        assets = []
+        for root, _, files in os.walk(app.static_folder):
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+                if rel == 'sw.js': continue
+                with open(path, 'rb') as f:
+                    assets.append({'url': f'/static/{rel}', 'revision': hashlib.sha256(f.read()).hexdigest()[:12]})
+        assets.sort(key=lambda a: a['url'])
+        revision = hashlib.sha256(''.join(a['revision'] for a in assets).encode()).hexdigest()[:12]
+        return {'revision': revision, 'assets': assets}
+    return cache.get_or_load(('precache_manifest',), build, ttl=60)
+
+def run_startup_tasks():
+    # Runs once per deployment: in the gunicorn master (gunicorn.conf.py) or before the dev server
     with app.app_context():
-        db.create_all()
+        run_migrations()
         init_achievements()
-        # Auto-migration for new Task columns if missing
-        with db.engine.connect() as con:
-            for cmd in [
-                "ALTER TABLE task ADD COLUMN scheduled_date DATE",
-                "ALTER TABLE task ADD COLUMN is_shared BOOLEAN DEFAULT 0",
-                "ALTER TABLE task ADD COLUMN shared_id VARCHAR(36)",
-                "ALTER TABLE user ADD COLUMN screen_time_limit INTEGER DEFAULT 120"
-            ]:
-                try:
-                    con.execute(db.text(cmd))
-                    con.commit()
-                except Exception:
-                    pass 
-        print("Database migrations checked.")
+        # Forked workers must not inherit pooled connections
+        db.engine.dispose()
+    print("Database migrations checked.")
+
+def create_app():
+    # WSGI entry point: gunicorn -c gunicorn.conf.py "app:create_app()"
+    return app
+
+if __name__ == '__main__':
+    # Development server only; production runs gunicorn (see Dockerfile)
+    run_startup_tasks()
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,26 @@
+# Gunicorn settings for production (used by the Docker image).
+# Tune with environment variables instead of editing this file.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# SQLite has a single writer, so a few processes with many threads scale best.
+# With Postgres, raise WEB_CONCURRENCY towards 2 * CPU cores + 1.
+workers = int(os.environ.get('WEB_CONCURRENCY', min(4, multiprocessing.cpu_count())))
+worker_class = 'gthread'
+# /api/state/stream holds one thread per open dashboard (up to STATE_STREAM_MAX, default half the threads)
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 75))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    # Migrations and achievement seeding run once in the master, not per worker
+    from app import run_startup_tasks
+    run_startup_tasks()
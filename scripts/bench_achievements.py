@@ -0,0 +1,35 @@
+# check_new_achievements for a user with many completed logs (100 habits x --days days).
+# It reads the running counters on User, so neither time nor query count grows with the history.
+import argparse
+import sqlite3
+from datetime import date, timedelta
+
+from benchlib import count_queries, load_app, per_call_ms
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--days', type=int, default=1000)
+parser.add_argument('--db', default=None, help='database file (default: a temporary file)')
+args = parser.parse_args()
+
+habitflow = load_app(args.db)
+with habitflow.app.app_context():
+    today = date.today()
+    con = sqlite3.connect(habitflow.db.engine.url.database)
+    con.execute("INSERT INTO user (id, username, password, current_streak) VALUES (1, 'bench', 'x', 0)")
+    con.executemany("INSERT INTO habit (id, text, user_id, frequency, days, target, is_shared) VALUES (?, ?, 1, 'daily', '0,1,2,3,4,5,6', 1, 0)",
+                    [(i, f'h{i}') for i in range(1, 101)])
+    con.executemany("INSERT INTO habit_log (habit_id, date, value, completed) VALUES (?, ?, 1, 1)",
+                    ((h, (today - timedelta(days=d)).isoformat()) for h in range(1, 101) for d in range(args.days)))
+    con.commit()
+    con.close()
+    habitflow.rebuild_user_counters()
+    habitflow.db.session.commit()
+
+    user = habitflow.db.session.get(habitflow.User, 1)
+    habitflow.check_new_achievements(user)  # Earn everything reachable once, like a long-time user
+    check = lambda: habitflow.check_new_achievements(user, ['habits_completed', 'streak'])
+    check()  # Reloads the user row expired by the commit above
+    with count_queries(habitflow) as statements:
+        check()
+    print(f'completed logs: {100 * args.days}')
+    print(f'check_new_achievements: {per_call_ms(check, runs=200):.3f} ms, {len(statements)} queries per call')
@@ -0,0 +1,85 @@
+# Concurrent toggles and /api/state reads against one SQLite file, one process per client (like
+# gunicorn workers; threads would mostly measure the GIL). Writers and readers contend for the
+# database locks; failed toggles (e.g. "database is locked" past busy_timeout) count as errors.
+# --mode baseline skips configure_sqlite_connection (rollback journal, synchronous=FULL, SQLite's own
+# cache/mmap defaults); the default runs both modes one after the other.
+import argparse
+import multiprocessing
+import subprocess
+import sys
+import time
+
+from benchlib import load_app, login
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--writers', type=int, default=4)
+parser.add_argument('--readers', type=int, default=8)
+parser.add_argument('--seconds', type=float, default=5)
+parser.add_argument('--db', default=None, help='database file (default: a temporary file)')
+parser.add_argument('--mode', choices=['tuned', 'baseline', 'both'], default='both')
+args = parser.parse_args()
+
+if args.mode == 'both':
+    # Each mode in its own process: the connection pragmas are bound when app.py is imported
+    for mode in ('baseline', 'tuned'):
+        subprocess.run([sys.executable, __file__, *sys.argv[1:], '--mode', mode], check=True)
+    raise SystemExit
+
+habitflow = load_app(args.db)
+if args.mode == 'baseline':
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    event.remove(Engine, 'connect', habitflow.configure_sqlite_connection)
+    with habitflow.app.app_context():
+        habitflow.db.engine.dispose()
+        # WAL is stored in the database file; switch it back to the rollback journal
+        with habitflow.db.engine.connect() as con:
+            con.exec_driver_sql('PRAGMA journal_mode=DELETE')
+clients = []
+for i in range(args.writers + args.readers):
+    client = login(habitflow, f'user{i}')
+    client.post('/api/add_habit', json={'text': 'Bench', 'target': 10 ** 6})
+    clients.append((client, client.get('/api/state').get_json()['habits'][0]['id']))
+with habitflow.app.app_context():
+    journal = habitflow.db.session.execute(habitflow.db.text('PRAGMA journal_mode')).scalar()
+    synchronous = habitflow.db.session.execute(habitflow.db.text('PRAGMA synchronous')).scalar()
+    # Forked children must open their own connections
+    habitflow.db.engine.dispose()
+
+
+def run(kind, index, start, results):
+    client, habit_id = clients[index]
+    done = errors = 0
+    while time.time() < start:
+        time.sleep(0.01)
+    stop = start + args.seconds
+    while time.time() < stop:
+        if kind == 'write':
+            body = client.post('/api/toggle_habit', json={'id': habit_id}).get_json(silent=True)
+            ok = bool(body and body.get('success'))
+        else:
+            ok = client.get('/api/state').status_code == 200
+        done += ok
+        errors += not ok
+    results.put((kind, done, errors))
+
+
+context = multiprocessing.get_context('fork')
+results = context.Queue()
+start = time.time() + 1
+workers = [context.Process(target=run, args=('write', i, start, results)) for i in range(args.writers)]
+workers += [context.Process(target=run, args=('read', args.writers + i, start, results)) for i in range(args.readers)]
+for p in workers:
+    p.start()
+totals = {'write': 0, 'read': 0, 'errors': 0}
+for _ in workers:
+    kind, done, errors = results.get()
+    totals[kind] += done
+    totals['errors'] += errors
+for p in workers:
+    p.join()
+
+print(f'{args.mode}: journal_mode={journal}, synchronous={synchronous}, '
+      f'{args.writers} writer / {args.readers} reader processes, {args.seconds:g} s')
+print(f"toggles/s: {totals['write'] / args.seconds:.0f}  state reads/s: {totals['read'] / args.seconds:.0f}  "
+      f"errors: {totals['errors']}")
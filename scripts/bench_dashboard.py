@@ -0,0 +1,40 @@
+# Time to render / (pre-rendered lists, embedded state) with a warm and a cold state cache,
+# plus the queries per open. 19 habits and 10 tasks by default.
+import argparse
+
+from benchlib import count_queries, load_app, login, per_call_ms
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--habits', type=int, default=19)
+parser.add_argument('--tasks', type=int, default=10)
+parser.add_argument('--runs', type=int, default=200)
+args = parser.parse_args()
+
+habitflow = load_app()
+client = login(habitflow, 'bench')
+for i in range(args.habits):
+    client.post('/api/add_habit', json={'text': f'Habit {i}', 'target': 3 if i % 4 == 0 else 1})
+for i in range(args.tasks):
+    client.post('/api/add_task', json={'text': f'Task {i}'})
+state = client.get('/api/state').get_json()
+for habit in state['habits'][:3]:
+    client.post('/api/toggle_habit', json={'id': habit['id']})
+client.post('/api/toggle_task', json={'id': state['tasks'][0]['id']})
+
+client.get('/')
+with count_queries(habitflow) as warm:
+    client.get('/')
+warm_ms = per_call_ms(lambda: client.get('/'), runs=args.runs)
+
+
+def cold_open():
+    habitflow.cache.clear()
+    client.get('/')
+
+
+with count_queries(habitflow) as cold:
+    cold_open()
+cold_ms = per_call_ms(cold_open, runs=args.runs)
+print(f'{args.habits} habits, {args.tasks} tasks')
+print(f'/ cache hit:  {warm_ms:.2f} ms, {len(warm)} queries')
+print(f'/ cache miss: {cold_ms:.2f} ms, {len(cold)} queries')
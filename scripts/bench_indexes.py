@@ -0,0 +1,50 @@
+# Dashboard state and toggle lookups on a large habit_log table (1000 habits x --days days), timed with
+# the hot-lookup indexes and again after dropping them (the schema before they were declared).
+# Without them both degrade to full scans.
+import argparse
+import sqlite3
+from datetime import date, timedelta
+
+from benchlib import load_app, per_call_ms
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--days', type=int, default=1000)
+parser.add_argument('--db', default=None, help='database file (default: a temporary file)')
+args = parser.parse_args()
+
+# Declared on Habit, HabitLog and Task for the dashboard and toggle lookups
+HOT_INDEXES = ['ix_habit_user_id', 'ix_habit_shared_id', 'ix_task_user_id', 'ix_task_shared_scheduled', 'uq_habit_log_habit_date']
+
+habitflow = load_app(args.db)
+with habitflow.app.app_context():
+    path = habitflow.db.engine.url.database
+    today = date.today()
+    con = sqlite3.connect(path)
+    con.execute("INSERT INTO user (id, username, password, current_streak) VALUES (1, 'bench', 'x', 0)")
+    # User 1 owns 10 habits; the other 990 belong to other users and only add volume
+    con.executemany("INSERT INTO habit (id, text, user_id, frequency, days, target, is_shared) VALUES (?, ?, ?, 'daily', '0,1,2,3,4,5,6', 1, 0)",
+                    [(i, f'h{i}', 1 if i <= 10 else 2 + i // 10) for i in range(1, 1001)])
+    con.executemany("INSERT INTO habit_log (habit_id, date, value, completed) VALUES (?, ?, 1, 1)",
+                    ((h, (today - timedelta(days=d)).isoformat()) for h in range(1, 1001) for d in range(args.days)))
+    con.commit()
+    con.close()
+
+    oldest = today - timedelta(days=args.days - 1)
+    print(f'habit_log rows: {1000 * args.days}')
+
+    def measure():
+        habitflow.db.session.remove()
+        user = habitflow.db.session.get(habitflow.User, 1)
+        state = per_call_ms(lambda: habitflow.compute_user_state(user))
+        toggle = per_call_ms(lambda: habitflow.HabitLog.query.filter_by(habit_id=995, date=oldest).first())
+        return state, toggle
+
+    after = measure()
+    con = sqlite3.connect(path)
+    for name in HOT_INDEXES:
+        con.execute(f'DROP INDEX {name}')
+    con.commit()
+    con.close()
+    before = measure()
+    print(f'compute_user_state (10 habits): {before[0]:.2f} ms without indexes -> {after[0]:.2f} ms with')
+    print(f'toggle log lookup (oldest day): {before[1]:.2f} ms without indexes -> {after[1]:.2f} ms with')
@@ -0,0 +1,57 @@
+# /api/leaderboard with 10, 100 and 500 friends that all have scores, next to what computing the
+# ranking on request would cost (a COUNT query per friend and metric).
+import random
+import time
+from datetime import date
+
+from benchlib import count_queries, load_app, login
+
+habitflow = load_app()
+client = login(habitflow, 'bench')
+rnd = random.Random(1)
+with habitflow.app.app_context():
+    me = habitflow.User.query.filter_by(username='bench').one().id
+    week_start = habitflow.get_start_of_week(date.today()).isoformat()
+    con = habitflow.db.session.connection()
+    con.exec_driver_sql('INSERT INTO "user" (id, username, password, current_streak) VALUES (?, ?, ?, ?)',
+                        [(1000 + i, f'friend{i}', 'x', rnd.randint(0, 50)) for i in range(500)])
+    con.exec_driver_sql('INSERT INTO leaderboard_score (user_id, week_start, week_completions, achievement_count) VALUES (?, ?, ?, ?)',
+                        [(1000 + i, week_start, rnd.randint(0, 30), rnd.randint(0, 8)) for i in range(500)])
+    habitflow.db.session.commit()
+
+
+def per_friend_counts(friend_ids):
+    week = habitflow.get_start_of_week(date.today())
+    rows = []
+    for fid in friend_ids:
+        user = habitflow.db.session.get(habitflow.User, fid)
+        completions = habitflow.HabitLog.query.join(habitflow.Habit).filter(
+            habitflow.Habit.user_id == fid, habitflow.HabitLog.completed == True, habitflow.HabitLog.date >= week).count()
+        achievements = habitflow.UserAchievement.query.filter_by(user_id=fid).count()
+        rows.append((user.current_streak, completions, achievements))
+    return sorted(rows, reverse=True)[:10]
+
+
+friends = 0
+for target in (10, 100, 500):
+    with habitflow.app.app_context():
+        habitflow.db.session.connection().exec_driver_sql(
+            'INSERT INTO friendship (sender_id, receiver_id, status) VALUES (?, ?, ?)',
+            [(1000 + i, me, 'accepted') for i in range(friends, target)])
+        habitflow.User.query.filter_by(id=me).update({'friends_version': habitflow.User.friends_version + 1})
+        habitflow.db.session.commit()
+    friends = target
+
+    client.get('/api/leaderboard')
+    with count_queries(habitflow) as statements:
+        started = time.perf_counter()
+        for _ in range(20):
+            client.get('/api/leaderboard')
+        endpoint_ms = (time.perf_counter() - started) / 20 * 1000
+    with habitflow.app.app_context():
+        with count_queries(habitflow) as naive_statements:
+            started = time.perf_counter()
+            per_friend_counts(range(1000, 1000 + friends))
+            naive_ms = (time.perf_counter() - started) * 1000
+    print(f'{friends:>3} friends: leaderboard {endpoint_ms:6.2f} ms, {len(statements) // 20} queries | '
+          f'per-friend COUNTs {naive_ms:7.1f} ms, {len(naive_statements)} queries')
@@ -0,0 +1,61 @@
+# Shared setup for the benchmark scripts in this directory: a throwaway SQLite database,
+# logged-in test clients and a statement counter. Run the scripts from the repository root,
+# e.g. `python scripts/bench_indexes.py`.
+import logging
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(db_path=None):
+    # Imports app.py against a fresh database file; must run before anything else imports app
+    if db_path is None:
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+    sys.path.insert(0, ROOT)
+    import app as habitflow
+    logging.disable(logging.INFO)
+    with habitflow.app.app_context():
+        habitflow.db.create_all()
+        habitflow.init_achievements()
+    return habitflow
+
+
+def login(habitflow, username, password='pw'):
+    client = habitflow.app.test_client()
+    if client.post('/register', data={'username': username, 'password': password}).status_code != 302:
+        client.post('/login', data={'username': username, 'password': password})
+    return client
+
+
+@contextmanager
+def count_queries(habitflow):
+    from sqlalchemy import event
+    statements = []
+    with habitflow.app.app_context():
+        engine = habitflow.db.engine
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+def per_call_ms(fn, runs=50):
+    fn()  # warm-up
+    started = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return (time.perf_counter() - started) / runs * 1000
@@ -0,0 +1,78 @@
+# HTTP load test against a running server (dev server or gunicorn), e.g.
+#   gunicorn -c gunicorn.conf.py "app:create_app()" &
+#   python scripts/load_test.py --url http://127.0.0.1:5000 --clients 16
+# Each client registers its own user and keeps one keep-alive connection; /api/state and
+# /api/toggle_habit are measured one after the other.
+import argparse
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+import uuid
+
+def connect(i):
+    conn = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=60)
+    form = urllib.parse.urlencode({'username': f'load-{run_id}-{i}', 'password': 'pw'})
+    conn.request('POST', '/register', form, {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    cookie = response.getheader('Set-Cookie')
+    if response.status != 302 or not cookie:
+        raise SystemExit(f'Registering load-{run_id}-{i} failed: {response.status}')
+    headers = {'Cookie': cookie.split(';')[0], 'Content-Type': 'application/json'}
+    conn.request('POST', '/api/add_habit', json.dumps({'text': 'Load', 'target': 10 ** 6}), headers)
+    conn.getresponse().read()
+    conn.request('GET', '/api/state', headers=headers)
+    habit_id = json.loads(conn.getresponse().read())['habits'][0]['id']
+    return conn, headers, habit_id
+
+
+def measure(path, sessions):
+    done, errors = [0], [0]
+    lock = threading.Lock()
+    stop = time.monotonic() + args.seconds
+
+    def request(conn, headers, habit_id):
+        if path == '/api/state':
+            conn.request('GET', path, headers=headers)
+        else:
+            conn.request('POST', path, json.dumps({'id': habit_id}), headers)
+        response = conn.getresponse()
+        response.read()
+        return response
+
+    def run(conn, headers, habit_id):
+        while time.monotonic() < stop:
+            try:
+                response = request(conn, headers, habit_id)
+            except (http.client.RemoteDisconnected, ConnectionError):
+                # The server closed an idle keep-alive connection; http.client reconnects on the next request
+                conn.close()
+                response = request(conn, headers, habit_id)
+            with lock:
+                if response.status == 200: done[0] += 1
+                else: errors[0] += 1
+
+    threads = [threading.Thread(target=run, args=s) for s in sessions]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print(f'{path}: {done[0] / args.seconds:.0f} req/s, {errors[0]} errors')
+
+
+# The file name matches pytest's *_test.py pattern, so nothing may run on import
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+    target = urllib.parse.urlsplit(args.url)
+    run_id = uuid.uuid4().hex[:8]
+
+    sessions = [connect(i) for i in range(args.clients)]
+    print(f'{args.url}, {args.clients} keep-alive clients, {args.seconds:g} s per route')
+    measure('/api/state', sessions)
+    measure('/api/toggle_habit', sessions)
@@ -5,7 +5,9 @@ let state = {
     streak: 0
 };
 let lastServerStateJson = "";
+let lastStateEtag = null;
 let pendingRequests = 0;
+let outboxPending = 0; // Mutations queued by the service worker while offline
 let selectedDays = [];
 let currentEntryType = 'habit'; // 'habit' or 'task'
 let currentHabitFrequency = 'daily';
@@ -18,24 +20,34 @@ const getEl = (id) => document.getElementById(id);
 // Init
 document.addEventListener('DOMContentLoaded', () => {
     if (typeof INITIAL_STATE !== 'undefined') {
+        // The page already carries the current state (and its markup): no extra /api/state round trip
         state = { ...INITIAL_STATE };
         lastServerStateJson = JSON.stringify(state);
+        lastStateEtag = `"${INITIAL_STATE_ETAG}"`;
         render();
+        watchState();
+    } else {
+        syncState().then(watchState);
     }
 
-    syncState();
-
-    setInterval(() => {
-        if (pendingRequests === 0) {
-            syncState(true);
-        }
-    }, 2000);
-
     if ('serviceWorker' in navigator) {
         navigator.serviceWorker.register('/sw.js');
+        navigator.serviceWorker.addEventListener('message', onServiceWorkerMessage);
+        // Replay queued mutations on browsers without Background Sync
+        const replay = () => navigator.serviceWorker.controller && navigator.serviceWorker.controller.postMessage({ type: 'replay' });
+        navigator.serviceWorker.ready.then(replay);
+        window.addEventListener('online', replay);
     }
 });
 
+function onServiceWorkerMessage(event) {
+    const msg = event.data || {};
+    if (msg.type === 'outbox') {
+        outboxPending = msg.pending;
+        if (outboxPending === 0 && msg.replayed) syncState();
+    }
+}
+
 function render() {
     // Render Hero Stats
     const totalHabits = state.habits.length;
@@ -153,43 +165,183 @@ function render() {
     }
 }
 
+async function applyStateResponse(res, data = null) {
+    // Server state does not know about queued offline changes yet; keep the optimistic UI until they are replayed
+    if (outboxPending > 0) return;
+    lastStateEtag = res.headers.get('ETag');
+    if (data === null) data = await res.json();
+    const json = JSON.stringify(data);
+    if (json === lastServerStateJson) return;
+    lastServerStateJson = json;
+    state = data;
+    render();
+    if (currentDetailId) refreshCurrentDetail();
+}
+
+// Mutation routes answer with the changed entries ({delta, version}); patch them into the last
+// server state instead of fetching /api/state again
+async function applyMutationResult(data) {
+    if (data.queued || outboxPending > 0) return;
+    if (!data.delta) return syncState();
+    const base = lastServerStateJson ? JSON.parse(lastServerStateJson) : state;
+    const patch = (list, entries, removed) => {
+        const next = list.filter(e => !removed.includes(e.id));
+        entries.forEach(entry => {
+            const i = next.findIndex(e => e.id === entry.id);
+            if (i === -1) next.push(entry); else next[i] = entry;
+        });
+        return next;
+    };
+    const next = {
+        ...base,
+        habits: patch(base.habits, data.delta.habits, data.delta.removed_habits),
+        tasks: patch(base.tasks, data.delta.tasks, data.delta.removed_tasks),
+        streak: data.delta.streak
+    };
+    // Same order as the server: open tasks first, then by id
+    next.tasks.sort((a, b) => (a.completed - b.completed) || (a.id - b.id));
+    lastStateEtag = `"${data.version}"`;
+    lastServerStateJson = JSON.stringify(next);
+    state = next;
+    render();
+    if (currentDetailId) refreshCurrentDetail();
+}
+
 async function syncState(isPolling = false) {
     try {
-        const res = await fetch('/api/state');
-        if (res.ok) {
-            const data = await res.json();
-            const json = JSON.stringify(data);
-            if (json === lastServerStateJson) return;
-            lastServerStateJson = json;
-            state = data;
-            render();
-            if (currentDetailId) refreshCurrentDetail();
-        }
+        const headers = lastStateEtag ? { 'If-None-Match': lastStateEtag } : {};
+        // Always asks the server: If-None-Match is our own ETag, not the browser cache's
+        const res = await fetch('/api/state', { headers, cache: 'no-store' });
+        if (res.status === 304) return;
+        if (res.ok) await applyStateResponse(res);
     } catch (e) {
         if (!isPolling) console.error("Sync failed", e);
     }
 }
 
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+
+// Long-poll: the server holds /api/state/stream open until our state changes.
+// Falls back to conditional polling while the stream is unavailable.
+const STREAM_MIN_CYCLE_MS = 2000;
+
+async function watchState() {
+    let fallbackDelay = 2000;
+    while (true) {
+        if (document.hidden) {
+            await new Promise(resolve => document.addEventListener('visibilitychange', resolve, { once: true }));
+            continue;
+        }
+        try {
+            const headers = lastStateEtag ? { 'If-None-Match': lastStateEtag } : {};
+            const started = Date.now();
+            const res = await fetch('/api/state/stream', { headers, cache: 'no-store' });
+            if (res.status !== 304 && !res.ok) throw new Error(`Stream failed: ${res.status}`);
+            // Own mutations resync after their POST and queued offline changes after their replay;
+            // avoid overwriting the optimistic UI
+            const applied = res.ok && pendingRequests === 0 && outboxPending === 0;
+            if (applied) await applyStateResponse(res);
+            fallbackDelay = 2000;
+            // A skipped response keeps our ETag stale and an immediate 304 means the server is out of
+            // stream slots: either way the next request would return at once, so wait instead of spinning
+            const elapsed = Date.now() - started;
+            if (!applied && elapsed < STREAM_MIN_CYCLE_MS) {
+                const retryAfter = Number(res.headers.get('Retry-After')) * 1000;
+                await sleep(Math.max(retryAfter || 0, STREAM_MIN_CYCLE_MS - elapsed));
+            }
+        } catch (e) {
+            await sleep(fallbackDelay);
+            if (pendingRequests === 0) await syncState(true);
+            fallbackDelay = Math.min(fallbackDelay * 2, 30000);
+        }
+    }
+}
+
+function newIdempotencyKey() {
+    return crypto.randomUUID ? crypto.randomUUID() : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+// Mutations carry an Idempotency-Key so the service worker can queue them offline and replay them safely,
+// and the id of this page's user so a replay after an account switch is rejected
+function userHeaders() {
+    const meta = document.querySelector('meta[name="habitflow-user"]');
+    return meta ? { 'X-Habitflow-User': meta.content } : {};
+}
+
+async function postMutation(endpoint, data) {
+    const res = await fetch(`/api/${endpoint}`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', 'Idempotency-Key': newIdempotencyKey(), ...userHeaders() },
+        body: JSON.stringify(data),
+        keepalive: true // Lets a batch flushed on tab close still arrive
+    });
+    if (res.status === 202) outboxPending = Math.max(outboxPending, 1);
+    return res;
+}
+
 async function apiCallWithSync(endpoint, data) {
     pendingRequests++;
     try {
-        const res = await fetch(`/api/${endpoint}`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(data)
-        });
-        if (res.ok) {
-            await syncState();
+        const res = await postMutation(endpoint, data);
+        if (res.status === 202) return true; // Queued offline, the optimistic UI stays
+        const body = await res.json();
+        if (res.ok && body.success) {
+            await applyMutationResult(body);
             return true;
         }
+        console.error(`${endpoint} rejected: ${body.message || res.status}`);
     } catch (e) {
         console.error(e);
     } finally {
         pendingRequests--;
     }
+    syncState(); // Roll the optimistic UI back to the server state
     return false;
 }
 
+// Rapid taps are collected for a moment and sent together to /api/batch:
+// one request, one commit and the new state in the response
+const BATCH_DELAY_MS = 400;
+let batchQueue = [];
+let batchTimer = null;
+
+function queueOperation(op) {
+    batchQueue.push(op);
+    pendingRequests++;
+    clearTimeout(batchTimer);
+    batchTimer = setTimeout(flushBatch, BATCH_DELAY_MS);
+}
+
+async function flushBatch() {
+    clearTimeout(batchTimer);
+    batchTimer = null;
+    const ops = batchQueue;
+    batchQueue = [];
+    if (ops.length === 0) return;
+    try {
+        const res = await postMutation('batch', { ops });
+        if (res.status === 202) return; // Queued offline, the optimistic UI stays
+        // A rejected batch answers {success: false, failed: <op index>, message} and changed nothing
+        const data = await res.json();
+        if (!res.ok || data.success === false) {
+            console.error(`Batch operation ${data.failed} rejected: ${data.message || res.status}`);
+            await syncState();
+        } else if (batchQueue.length === 0) {
+            // Taps made while this batch was in flight are already shown; their batch brings the state
+            await applyStateResponse(res, data);
+        }
+    } catch (e) {
+        console.error(e);
+        syncState();
+    } finally {
+        pendingRequests -= ops.length;
+    }
+}
+
+document.addEventListener('visibilitychange', () => {
+    if (document.hidden) flushBatch();
+});
+
 // Actions
 async function toggleHabit(index) {
     const habit = state.habits[index];
@@ -204,8 +356,7 @@ async function toggleHabit(index) {
         }
     }
     render();
-    const success = await apiCallWithSync('toggle_habit', { id: habit.id });
-    if (!success) syncState();
+    queueOperation({ op: 'toggle_habit', id: habit.id });
 }
 
 async function toggleHabitFromDetail() {
@@ -230,8 +381,7 @@ async function toggleTask(index) {
     const task = state.tasks[index];
     task.completed = !task.completed;
     render();
-    const success = await apiCallWithSync('toggle_task', { id: task.id });
-    if (!success) syncState();
+    queueOperation({ op: 'toggle_task', id: task.id });
 }
 
 // ENTRY MODAL LOGIC
@@ -345,13 +495,30 @@ function populateTaskDatesModal() {
     }
 }
 
+// Friend list for the share and invite modals; friendships only change on the friends page,
+// so one fetch is reused for a minute instead of reloading on every modal open
+const FRIENDS_MAX_AGE_MS = 60000;
+let friendsRequest = null;
+let friendsFetchedAt = 0;
+
+function fetchFriends() {
+    if (!friendsRequest || Date.now() - friendsFetchedAt > FRIENDS_MAX_AGE_MS) {
+        friendsFetchedAt = Date.now();
+        friendsRequest = fetch('/api/get_friends').then((res) => {
+            if (!res.ok) throw new Error(`get_friends: ${res.status}`);
+            return res.json();
+        });
+        friendsRequest.catch(() => { friendsRequest = null; });
+    }
+    return friendsRequest;
+}
+
 async function loadFriendsForModal() {
     const container = getEl('friends-selector-modal');
     if (!container) return;
     container.innerHTML = '<p class="text-xs text-gray-500">Lade Freunde...</p>';
     try {
-        const res = await fetch('/api/get_friends');
-        const friends = await res.json();
+        const friends = await fetchFriends();
         container.innerHTML = '';
         if (friends.length === 0) {
             container.innerHTML = '<p class="text-xs text-gray-500">Keine Freunde gefunden.</p>';
@@ -504,15 +671,16 @@ async function deleteCurrentHabit() {
     if (!confirm('Möchtest du diese Gewohnheit wirklich löschen?')) return;
 
     try {
-        const res = await fetch('/api/delete_habit', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ id: currentDetailId })
-        });
+        const id = currentDetailId;
+        const res = await postMutation('delete_habit', { id });
         const data = await res.json();
         if (data.success) {
+            if (data.queued) {
+                state.habits = state.habits.filter(h => h.id !== id);
+                render();
+            }
             closeDetails();
-            syncState(true);
+            applyMutationResult(data);
         } else {
             alert('Fehler beim Löschen.');
         }
@@ -526,14 +694,14 @@ async function deleteTask(id, event) {
     if (!confirm('Aufgabe entfernen?')) return;
 
     try {
-        const res = await fetch('/api/delete_task', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ id })
-        });
+        const res = await postMutation('delete_task', { id });
         const data = await res.json();
         if (data.success) {
-            syncState(true);
+            if (data.queued) {
+                state.tasks = state.tasks.filter(t => t.id !== id);
+                render();
+            }
+            applyMutationResult(data);
         }
     } catch (e) { console.error(e); }
 }
@@ -590,15 +758,16 @@ async function deleteCurrentTask() {
     if (!currentTaskDetailId) return;
     if (!confirm('Aufgabe wirklich löschen?')) return;
     try {
-        const res = await fetch('/api/delete_task', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ id: currentTaskDetailId })
-        });
+        const id = currentTaskDetailId;
+        const res = await postMutation('delete_task', { id });
         const data = await res.json();
         if (data.success) {
+            if (data.queued) {
+                state.tasks = state.tasks.filter(t => t.id !== id);
+                render();
+            }
             closeTaskDetails();
-            syncState(true);
+            applyMutationResult(data);
         }
     } catch (e) { console.error(e); }
 }
@@ -618,8 +787,7 @@ async function toggleTaskFromDetail() {
 // INVITE LOGIC
 async function showInviteModal() {
     if (!currentDetailId) return;
-    const res = await fetch('/api/get_friends');
-    const friends = await res.json();
+    const friends = await fetchFriends();
     const list = getEl('invite-friends-list');
     const modal = getEl('invite-friends-modal');
 
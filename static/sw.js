@@ -1,38 +1,238 @@
-const CACHE_NAME = 'habitflow-v2-dynamic'; // Updated
-const ASSETS = [
-    '/static/style.css',
-    '/static/icon-192.png',
-    '/static/icon-512.png'
-    // app.js and index not hard-cached to force reload on dev
-];
+// Served by /sw.js in app.py, which prepends self.__PRECACHE_MANIFEST = {revision, assets: [{url, revision}]}
+// built from the content hashes of static/. Any asset change therefore ships a new service worker.
+const MANIFEST = self.__PRECACHE_MANIFEST || { revision: 'dev', assets: [] };
+const PRECACHE = `habitflow-precache-${MANIFEST.revision}`;
+const RUNTIME = 'habitflow-runtime'; // Fonts, Tailwind, other static files
+const PAGES = 'habitflow-pages'; // Offline copy of the logged-in user's dashboard
+
+// Mutations that are queued in the outbox while offline and replayed in order
+const OUTBOX_ROUTES = ['/api/batch', '/api/toggle_habit', '/api/toggle_task', '/api/add_habit', '/api/add_task', '/api/delete_habit', '/api/delete_task'];
+// Queued mutations older than this are dropped: the server forgets Idempotency-Keys after 7 days
+// (prune_idempotency_keys), so a later replay could apply them twice
+const OUTBOX_MAX_AGE_MS = 7 * 24 * 60 * 60 * 1000;
+// Navigations that start or end a session; the cached dashboard belongs to the previous one
+const SESSION_ROUTES = ['/login', '/register', '/logout'];
 
 self.addEventListener('install', (event) => {
-    self.skipWaiting(); // Force active
+    self.skipWaiting();
     event.waitUntil(
-        caches.open(CACHE_NAME).then((cache) => {
-            return cache.addAll(ASSETS);
-        })
+        caches.open(PRECACHE).then((cache) =>
+            cache.addAll(MANIFEST.assets.map((asset) => new Request(asset.url, { cache: 'reload' })))
+        )
     );
 });
 
 self.addEventListener('activate', (event) => {
+    const keep = [PRECACHE, RUNTIME, PAGES];
     event.waitUntil(
-        caches.keys().then((cacheNames) => {
-            return Promise.all(
-                cacheNames.map((cache) => {
-                    if (cache !== CACHE_NAME) {
-                        return caches.delete(cache);
-                    }
-                })
-            );
-        })
+        caches.keys()
+            .then((names) => Promise.all(names.filter((name) => !keep.includes(name)).map((name) => caches.delete(name))))
+            .then(() => self.clients.claim())
     );
 });
 
 self.addEventListener('fetch', (event) => {
-    // Network First strategy for dev (always try net, fallback to cache)
-    event.respondWith(
-        fetch(event.request)
-            .catch(() => caches.match(event.request))
-    );
+    const request = event.request;
+    const url = new URL(request.url);
+
+    if (request.method === 'POST' && url.origin === self.location.origin && OUTBOX_ROUTES.includes(url.pathname)) {
+        event.respondWith(sendOrQueue(request));
+        return;
+    }
+    if (request.mode === 'navigate' && url.origin === self.location.origin && SESSION_ROUTES.includes(url.pathname)) {
+        // Login form posts included: the next user on a shared device must not get this dashboard offline
+        if (request.method === 'POST' || url.pathname === '/logout') {
+            event.respondWith(caches.delete(PAGES).then(() => fetch(request)));
+        }
+        return;
+    }
+    if (request.method !== 'GET') return;
+
+    if (url.origin === 'https://fonts.gstatic.com') {
+        event.respondWith(cacheFirst(request, RUNTIME));
+    } else if (url.origin === 'https://fonts.googleapis.com' || url.origin === 'https://cdn.tailwindcss.com') {
+        event.respondWith(staleWhileRevalidate(request, RUNTIME));
+    } else if (url.origin !== self.location.origin) {
+        return;
+    } else if (url.pathname.startsWith('/static/')) {
+        event.respondWith(precached(request).then((response) => response || staleWhileRevalidate(request, RUNTIME)));
+    } else if (url.pathname.startsWith('/api/')) {
+        // Never cached: a stored snapshot could hide a toggle or belong to another session (ETags revalidate at the server)
+        return;
+    } else if (request.mode === 'navigate' && url.pathname === '/') {
+        // Network first; the cached copy is only shown offline. Its long-poll corrects the embedded state.
+        event.respondWith(networkFirst(request, PAGES));
+    } else if (request.mode === 'navigate') {
+        event.respondWith(fetch(request).catch(() =>
+            caches.match(request).then((response) => response || caches.match('/', { cacheName: PAGES }))
+        ));
+    }
 });
+
+self.addEventListener('sync', (event) => {
+    if (event.tag === 'outbox') event.waitUntil(replayOutbox());
+});
+
+self.addEventListener('message', (event) => {
+    // Fallback for browsers without Background Sync: the page asks for a replay when it comes online
+    if (event.data && event.data.type === 'replay') event.waitUntil(replayOutbox().catch(() => {}));
+});
+
+// --- Caching strategies ---
+
+function cacheable(response) {
+    return response && (response.ok || response.type === 'opaque') && !response.redirected;
+}
+
+function precached(request) {
+    // Templates add ?v=<version> to asset URLs; the precache is keyed by path
+    return caches.open(PRECACHE).then((cache) => cache.match(request, { ignoreSearch: true }));
+}
+
+async function cacheFirst(request, cacheName) {
+    const cache = await caches.open(cacheName);
+    const cached = await cache.match(request);
+    if (cached) return cached;
+    const response = await fetch(request);
+    if (cacheable(response)) cache.put(request, response.clone());
+    return response;
+}
+
+async function networkFirst(request, cacheName) {
+    const cache = await caches.open(cacheName);
+    try {
+        const response = await fetch(request);
+        if (response.redirected || response.type === 'opaqueredirect') {
+            // Sent elsewhere (e.g. to /login after the session ended): the cached copy must not outlive it
+            await cache.delete(request.url);
+        } else if (cacheable(response) && response.status === 200) {
+            await cache.put(request.url, response.clone());
+        }
+        return response;
+    } catch (e) {
+        const cached = await cache.match(request.url);
+        if (cached) return cached;
+        throw e;
+    }
+}
+
+async function staleWhileRevalidate(request, cacheName) {
+    const cache = await caches.open(cacheName);
+    // Keyed by URL only, so conditional headers of the page do not split the cache
+    const cached = await cache.match(request.url);
+    const revalidate = fetch(request).then(async (response) => {
+        if (cacheable(response) && (response.status === 200 || response.type === 'opaque')) {
+            await cache.put(request.url, response.clone());
+        }
+        return response;
+    });
+    if (cached) {
+        revalidate.catch(() => {});
+        return cached;
+    }
+    return revalidate;
+}
+
+async function postToClients(message) {
+    const clients = await self.clients.matchAll({ type: 'window' });
+    clients.forEach((client) => client.postMessage(message));
+}
+
+// --- Outbox (IndexedDB) ---
+
+function openOutbox() {
+    return new Promise((resolve, reject) => {
+        const open = indexedDB.open('habitflow', 1);
+        open.onupgradeneeded = () => open.result.createObjectStore('outbox', { keyPath: 'id', autoIncrement: true });
+        open.onsuccess = () => resolve(open.result);
+        open.onerror = () => reject(open.error);
+    });
+}
+
+async function outbox(mode, action) {
+    const db = await openOutbox();
+    return new Promise((resolve, reject) => {
+        const tx = db.transaction('outbox', mode);
+        const req = action(tx.objectStore('outbox'));
+        tx.oncomplete = () => resolve(req.result);
+        tx.onerror = () => reject(tx.error);
+    });
+}
+
+const queuedRequests = () => outbox('readonly', (store) => store.getAll()); // Ordered by id = queue order
+
+async function sendOrQueue(request) {
+    const entry = {
+        url: request.url,
+        body: await request.clone().text(),
+        contentType: request.headers.get('Content-Type') || 'application/json',
+        key: request.headers.get('Idempotency-Key') || crypto.randomUUID(),
+        user: request.headers.get('X-Habitflow-User'), // The server rejects the replay for any other session user
+        queuedAt: Date.now()
+    };
+    // Later mutations must not overtake queued ones
+    await replayOutbox().catch(() => {});
+    if ((await queuedRequests()).length === 0) {
+        try {
+            return await fetch(request);
+        } catch (e) {
+            // Offline: fall through to the queue
+        }
+    }
+
+    await outbox('readwrite', (store) => store.add(entry));
+    if (self.registration.sync) await self.registration.sync.register('outbox').catch(() => {});
+    postToClients({ type: 'outbox', pending: (await queuedRequests()).length });
+    return new Response(JSON.stringify({ success: true, queued: true }), {
+        status: 202,
+        headers: { 'Content-Type': 'application/json' }
+    });
+}
+
+let replaying = null;
+
+function replayOutbox() {
+    // One replay at a time, strictly in queue order; the server drops duplicates by Idempotency-Key
+    if (!replaying) replaying = replayQueued().finally(() => { replaying = null; });
+    return replaying;
+}
+
+async function replayQueued() {
+    const entries = await queuedRequests();
+    if (entries.length === 0) return;
+    let replayed = 0;
+    try {
+        for (const entry of entries) {
+            if (Date.now() - entry.queuedAt > OUTBOX_MAX_AGE_MS) {
+                await outbox('readwrite', (store) => store.delete(entry.id));
+                continue;
+            }
+            const response = await fetch(entry.url, {
+                method: 'POST',
+                headers: { 'Content-Type': entry.contentType, 'Idempotency-Key': entry.key, ...(entry.user ? { 'X-Habitflow-User': entry.user } : {}) },
+                body: entry.body,
+                credentials: 'same-origin'
+            });
+            // Stops the replay and keeps this entry and all later ones for the next sync
+            if (!(await replayDone(response))) throw new Error(`Replay failed: ${response.status}`);
+            await outbox('readwrite', (store) => store.delete(entry.id));
+            replayed++;
+        }
+    } finally {
+        postToClients({ type: 'outbox', pending: (await queuedRequests()).length, replayed });
+    }
+}
+
+async function replayDone(response) {
+    // Only a JSON answer of the app itself settles an entry: a success, or any {success: false}
+    // rejection (also with 200 or 403), which a retry cannot change. A redirect (to /login), 401,
+    // a non-JSON body (proxy, captive portal) or a server error means "retry later".
+    if (response.redirected || response.status === 401 || response.status >= 500) return false;
+    if (!(response.headers.get('Content-Type') || '').includes('application/json')) return false;
+    try {
+        const body = await response.json();
+        return response.ok || body.success === false;
+    } catch (e) {
+        return false;
+    }
+}
@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import date
+
+import pytest
+from sqlalchemy import event
+
+# The app binds its engine at import time, so point it at a throwaway database first
+_fd, DB_PATH = tempfile.mkstemp(suffix='.db')
+os.close(_fd)
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + DB_PATH
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as habitflow  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_db():
+    habitflow.app.config['TESTING'] = True
+    # Keep the daily rollover thread from issuing queries in the middle of a test
+    habitflow._rollover_checked_day = date.today()
+    with habitflow.app.app_context():
+        habitflow.db.drop_all()
+        habitflow.db.session.execute(habitflow.db.text('DROP TABLE IF EXISTS user_search'))
+        habitflow.db.session.commit()
+        habitflow.db.create_all()
+        habitflow.init_achievements()
+    habitflow.cache.clear()
+    yield
+    with habitflow.app.app_context():
+        habitflow.db.session.remove()
+
+
+@pytest.fixture
+def login():
+    # login('alice') -> test client with a registered, logged-in user
+    def make(username, password='pw'):
+        client = habitflow.app.test_client()
+        response = client.post('/register', data={'username': username, 'password': password})
+        if response.status_code != 302:
+            client.post('/login', data={'username': username, 'password': password})
+        return client
+    return make
+
+
+def user_id(username):
+    with habitflow.app.app_context():
+        return habitflow.User.query.filter_by(username=username).one().id
+
+
+@contextmanager
+def count_queries():
+    # Collects every statement sent to the database while the block runs
+    statements = []
+    with habitflow.app.app_context():
+        engine = habitflow.db.engine
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
@@ -0,0 +1,66 @@
+import pytest
+
+import app as habitflow
+from conftest import user_id
+
+
+@pytest.fixture
+def alice_and_bob(login):
+    alice, bob = login('alice'), login('bob')
+    alice.post('/api/add_habit', json={'text': 'Run'})
+    bob.post('/api/add_habit', json={'text': 'Read'})
+    alice_habit = alice.get('/api/state').get_json()['habits'][0]['id']
+    bob_habit = bob.get('/api/state').get_json()['habits'][0]['id']
+    return alice, alice_habit, bob_habit
+
+
+@pytest.mark.parametrize('op, status', [
+    ('foreign_habit', 403),
+    ('empty_task', 400),
+    ('missing_habit', 404),
+    ('unknown', 400),
+])
+def test_rejected_operation_fails_the_whole_batch(alice_and_bob, op, status):
+    alice, alice_habit, bob_habit = alice_and_bob
+    failing = {
+        'foreign_habit': {'op': 'toggle_habit', 'id': bob_habit},
+        'empty_task': {'op': 'add_task', 'text': ''},
+        'missing_habit': {'op': 'toggle_habit', 'id': 10 ** 6},
+        'unknown': {'op': 'rename_habit', 'id': alice_habit},
+    }[op]
+    response = alice.post('/api/batch', json={'ops': [{'op': 'toggle_habit', 'id': alice_habit}, failing]})
+
+    assert response.status_code == status
+    body = response.get_json()
+    assert body['success'] is False
+    assert body['failed'] == 1
+    assert body['message']
+    # All or nothing: the first toggle was rolled back too
+    assert alice.get('/api/state').get_json()['habits'][0]['current'] == 0
+
+
+def test_single_routes_answer_rejections_with_4xx(alice_and_bob):
+    alice, alice_habit, bob_habit = alice_and_bob
+    assert alice.post('/api/toggle_habit', json={'id': bob_habit}).status_code == 403
+    assert alice.post('/api/delete_habit', json={'id': bob_habit}).status_code == 403
+    assert alice.post('/api/toggle_task', json={'id': 10 ** 6}).status_code == 404
+    response = alice.post('/api/add_task', json={'text': ''})
+    assert response.status_code == 400
+    assert response.get_json() == {'success': False, 'message': 'Text required'}
+    with habitflow.app.app_context():
+        assert habitflow.Habit.query.count() == 2
+
+
+def test_mutation_sent_for_another_user_is_rejected(alice_and_bob):
+    alice, alice_habit, bob_habit = alice_and_bob
+    assert f'<meta name="habitflow-user" content="{user_id("alice")}">' in alice.get('/').get_data(as_text=True)
+
+    # An outbox replay queued by bob, sent after alice logged in on the same device
+    response = alice.post('/api/add_habit', json={'text': 'Bob offline'}, headers={'X-Habitflow-User': str(user_id('bob'))})
+    assert response.status_code == 409
+    assert response.get_json()['success'] is False
+    response = alice.post('/api/batch', json={'ops': [{'op': 'toggle_habit', 'id': alice_habit}]},
+                          headers={'X-Habitflow-User': str(user_id('alice'))})
+    assert response.status_code == 200
+    with habitflow.app.app_context():
+        assert habitflow.Habit.query.count() == 2
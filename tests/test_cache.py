@@ -0,0 +1,29 @@
+import app as habitflow
+
+
+def test_stats_count_hits_misses_and_evictions():
+    cache = habitflow.TTLCache(max_entries=2)
+    cache.set(('a',), 1)
+    cache.set(('b',), 2)
+    assert cache.get(('a',)) == 1
+    cache.set(('c',), 3)  # Evicts ('b',), the least recently used
+    assert cache.get(('b',)) is None
+    assert cache.get_or_load(('d',), lambda: 4) == 4
+    assert cache.stats() == {'size': 2, 'hits': 1, 'misses': 2, 'evictions': 2, 'hit_rate': 0.333}
+
+
+class InlineThread:
+    # Runs the daily job when start() is called instead of in the background
+    def __init__(self, target, daemon):
+        self.target = target
+
+    def start(self):
+        self.target()
+
+
+def test_stats_are_logged_by_the_daily_job(caplog, monkeypatch):
+    monkeypatch.setattr(habitflow, '_rollover_checked_day', None)
+    monkeypatch.setattr(habitflow.threading, 'Thread', InlineThread)
+    with caplog.at_level('INFO', logger=habitflow.logger.name), habitflow.app.test_request_context():
+        habitflow.schedule_streak_rollover()
+    assert any(record.getMessage().startswith('Cache (pid') for record in caplog.records)
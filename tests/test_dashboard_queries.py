@@ -0,0 +1,78 @@
+import pytest
+
+import app as habitflow
+from conftest import count_queries, user_id
+
+# User row, habits, today's/this week's logs, habit group progress, tasks, task group progress
+DASHBOARD_QUERIES = 6
+
+
+def seed_dashboard(client, friend_id, habits):
+    for i in range(habits):
+        client.post('/api/add_habit', json={'text': f'Habit {i}', 'target': 2, 'friends': [friend_id] if i % 2 else []})
+    client.post('/api/add_habit', json={'text': 'Flex', 'frequency': 'weekly_flex', 'target': 3})
+    client.post('/api/add_task', json={'text': 'Shared task', 'friends': [friend_id]})
+    client.post('/api/add_task', json={'text': 'Task'})
+    for habit in client.get('/api/state').get_json()['habits'][:3]:
+        client.post('/api/toggle_habit', json={'id': habit['id']})
+
+
+@pytest.mark.parametrize('habits', [2, 20])
+def test_dashboard_query_count_is_constant(login, habits):
+    login('bob')
+    alice = login('alice')
+    seed_dashboard(alice, user_id('bob'), habits)
+
+    with count_queries() as statements:
+        assert alice.get('/').status_code == 200
+    assert len(statements) == DASHBOARD_QUERIES
+
+    # The state computed for the dashboard is reused; only the user row is read to check its version
+    with count_queries() as statements:
+        assert alice.get('/api/state').status_code == 200
+    assert len(statements) == 1
+
+
+@pytest.mark.parametrize('habits', [2, 20])
+def test_state_query_count_without_cache(login, habits):
+    login('bob')
+    alice = login('alice')
+    seed_dashboard(alice, user_id('bob'), habits)
+    habitflow.cache.clear()
+
+    with count_queries() as statements:
+        response = alice.get('/api/state')
+    assert response.status_code == 200
+    assert len(statements) == DASHBOARD_QUERIES
+
+    with count_queries() as statements:
+        response = alice.get('/api/state', headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+    assert len(statements) == 1
+
+
+FOCUS_TABLES = ('app_usage', 'app_limit')
+
+
+@pytest.mark.parametrize('path, focus', [
+    ('/', False),
+    ('/settings', False),
+    ('/api/state', False),
+    ('/focus-dashboard', True),
+])
+def test_focus_queries_only_on_focus_dashboard(login, path, focus):
+    login('bob')
+    alice = login('alice')
+    seed_dashboard(alice, user_id('bob'), 2)
+    alice.post('/api/sync_usage', json={'usage': [{'packageName': 'com.example', 'usageDuration': 30}]})
+    alice.post('/api/add_limit', data={'package': 'com.example', 'limit': 60})
+    habitflow.cache.clear()
+
+    with count_queries() as statements:
+        assert alice.get(path).status_code == 200
+    focus_statements = [s for s in statements if any(table in s for table in FOCUS_TABLES)]
+    if focus:
+        # Today's usage and the (then cached) limits
+        assert len(focus_statements) == 2
+    else:
+        assert focus_statements == []
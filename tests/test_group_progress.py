@@ -0,0 +1,69 @@
+from datetime import date, timedelta
+
+import app as habitflow
+from conftest import user_id
+
+
+def befriend(alice, **friends):
+    # Friendships go through the API like in the app: alice asks, the friend accepts
+    for name, client in friends.items():
+        alice.post('/api/add_friend', json={'id': user_id(name)})
+        client.post('/api/accept_friend', json={'id': user_id('alice')})
+
+
+def check():
+    with habitflow.app.app_context():
+        return habitflow.check_group_progress()
+
+
+def entry_ids(client, kind):
+    return [entry['id'] for entry in client.get('/api/state').get_json()[kind]]
+
+
+def test_checker_finds_no_drift_in_api_built_data(login):
+    alice, bob, carol = login('alice'), login('bob'), login('carol')
+    befriend(alice, bob=bob, carol=carol)
+    friends = [user_id('bob'), user_id('carol')]
+
+    alice.post('/api/add_habit', json={'text': 'Run', 'target': 2, 'friends': friends})
+    alice.post('/api/add_habit', json={'text': 'Read', 'friends': friends})
+    alice.post('/api/add_task', json={'text': 'Today', 'friends': friends})
+    alice.post('/api/add_task', json={'text': 'Tomorrow', 'offset': 1, 'friends': friends})
+    for client in (alice, bob):
+        for habit_id in entry_ids(client, 'habits'):
+            client.post('/api/toggle_habit', json={'id': habit_id})
+        client.post('/api/toggle_task', json={'id': entry_ids(client, 'tasks')[0]})
+    assert check() == []
+
+    # Yesterday's rows keep the group as it was; today carol leaves both habits and a task
+    with habitflow.app.app_context():
+        db, yesterday = habitflow.db, date.today() - timedelta(days=1)
+        habit_groups = db.session.query(habitflow.Habit.shared_id)
+        db.session.query(habitflow.HabitLog).update({'date': yesterday})
+        db.session.query(habitflow.SharedGroupProgress).filter(
+            habitflow.SharedGroupProgress.shared_id.in_(habit_groups)).update({'date': yesterday}, synchronize_session=False)
+        db.session.commit()
+    for habit_id in entry_ids(carol, 'habits'):
+        carol.post('/api/delete_habit', json={'id': habit_id})
+    carol.post('/api/delete_task', json={'id': entry_ids(carol, 'tasks')[0]})
+    # Alice's own shared task group disappears entirely; its row drops to 0/0
+    alice.post('/api/delete_task', json={'id': entry_ids(alice, 'tasks')[0]})
+    bob.post('/api/toggle_habit', json={'id': entry_ids(bob, 'habits')[0]})
+    assert check() == []
+
+
+def test_repair_rewrites_only_drifted_rows(login):
+    alice, bob = login('alice'), login('bob')
+    befriend(alice, bob=bob)
+    alice.post('/api/add_habit', json={'text': 'Run', 'friends': [user_id('bob')]})
+    alice.post('/api/toggle_habit', json={'id': entry_ids(alice, 'habits')[0]})
+
+    with habitflow.app.app_context():
+        progress = habitflow.SharedGroupProgress.query.one()
+        progress.members_done = 2
+        habitflow.db.session.commit()
+        key = (progress.shared_id, progress.date)
+        assert habitflow.check_group_progress(repair=True) == [(key, (2, 2), (1, 2))]
+        habitflow.db.session.commit()
+        assert habitflow.SharedGroupProgress.query.count() == 1
+    assert check() == []
@@ -0,0 +1,60 @@
+import threading
+import time
+
+import app as habitflow
+from conftest import user_id
+
+
+def test_stream_sees_changes_committed_by_another_worker(login, monkeypatch):
+    monkeypatch.setattr(habitflow, 'STATE_STREAM_RECHECK', 0.5)
+    alice = login('alice')
+    etag = alice.get('/api/state').headers['ETag']
+    uid = user_id('alice')
+
+    def other_worker():
+        # Bumps the version without going through this process' StateNotifier
+        time.sleep(0.3)
+        with habitflow.app.app_context():
+            with habitflow.db.engine.begin() as con:
+                con.execute(habitflow.db.text('UPDATE "user" SET state_version = state_version + 1 WHERE id = :id'), {'id': uid})
+
+    writer = threading.Thread(target=other_worker)
+    writer.start()
+    started = time.monotonic()
+    response = alice.get('/api/state/stream?timeout=10', headers={'If-None-Match': etag})
+    writer.join()
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert time.monotonic() - started < habitflow.STATE_STREAM_RECHECK + 1.5
+
+
+def test_stream_answers_immediately_when_slots_are_taken(login, monkeypatch):
+    alice = login('alice')
+    etag = alice.get('/api/state').headers['ETag']
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(habitflow, 'state_stream_slots', slots)
+
+    started = time.monotonic()
+    response = alice.get('/api/state/stream?timeout=10', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['Retry-After']
+    assert time.monotonic() - started < 1
+
+
+def test_notifier_forgets_users_nobody_waits_for(login):
+    alice, bob = login('alice'), login('bob')
+    etag = alice.get('/api/state').headers['ETag']
+
+    def toggle_soon():
+        time.sleep(0.3)
+        bob.post('/api/add_habit', json={'text': 'Read'})
+        alice.post('/api/add_habit', json={'text': 'Run'})
+
+    writer = threading.Thread(target=toggle_soon)
+    writer.start()
+    response = alice.get('/api/state/stream?timeout=10', headers={'If-None-Match': etag})
+    writer.join()
+    assert response.status_code == 200
+    # Neither bob (never waited) nor alice (her long-poll has returned) is still tracked
+    assert habitflow.state_notifier.waiting_users() == []